@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""agenda.py
+
+Per-user agenda: display copies of the conferences a user attends and of
+the sessions in their wishlist, kept in one Agenda entity.
+
+The Agenda is a child of the Profile, so registration and wishlist
+transactions update it together with the profile lists. ndb caches it in
+memcache, which makes getConferencesToAttend one memcache hit or one
+keyed read in the common case.
+
+The lists on the Profile stay authoritative. An agenda that is missing,
+or that lacks an entry the profile lists, is rebuilt from the source
+entities on the next read, skipping keys whose entity is gone. When the
+source changes (an organizer renames themselves), a background task
+deletes the affected agendas so they are rebuilt.
+
+"""
+
+__author__ = 'Yu Lei'
+
+from protorpc import protojson
+from google.appengine.ext import ndb
+
+from models import Agenda
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import SessionForm
+
+INVALIDATE_BATCH = 500
+
+
+def agendaKey(p_key):
+    return ndb.Key(Agenda, 'agenda', parent=p_key)
+
+
+def _forms(form_class, entries, wsks):
+    if any(wsk not in entries for wsk in wsks):
+        return None
+    # entries of deleted entities are None
+    return [protojson.decode_message(form_class, entries[wsk])
+            for wsk in wsks if entries[wsk] is not None]
+
+
+def conferenceForms(agenda, wscks):
+    """Return ConferenceForms for the given conferences that still exist,
+    in order, or None if the agenda lacks any of them.
+    """
+    return _forms(ConferenceForm, agenda.conferences or {}, wscks)
+
+
+def sessionForms(agenda, sessionKeys):
+    """Return SessionForms for the given sessions that still exist, in
+    order, or None if the agenda lacks any of them.
+    """
+    return _forms(SessionForm, agenda.sessions or {}, sessionKeys)
+
+
+def _encode(form):
+    return protojson.encode_message(form) if form is not None else None
+
+
+@ndb.transactional()
+def store(p_key, conferences, sessions):
+    """Store an agenda built from the profile's lists, given as
+    [(websafe key, form)] with form None for entities that are gone.
+
+    Entries the profile no longer lists are left out, so a registration
+    that committed while the agenda was being built is never undone; one
+    it added is missing and triggers another rebuild later.
+    """
+    prof = p_key.get()
+    attending = set(c_key.urlsafe() for c_key in prof.conferencesToAttend)
+    wishlist = set(s_key.urlsafe() for s_key in prof.sessionsInWishlist)
+    agenda = Agenda(key=agendaKey(p_key),
+        conferences=dict((wsck, _encode(cf))
+                         for wsck, cf in conferences if wsck in attending),
+        sessions=dict((sessionKey, _encode(sf))
+                      for sessionKey, sf in sessions if sessionKey in wishlist))
+    agenda.put()
+    return agenda
+
+
+def _update(p_key, field, wsk, form):
+    """Set or, with form None, drop one entry of an existing agenda; call
+    inside the transaction changing the matching profile list.
+    """
+    agenda = agendaKey(p_key).get()
+    if agenda is None:
+        # built from the profile lists on the next read
+        return
+    entries = getattr(agenda, field) or {}
+    if form is None:
+        entries.pop(wsk, None)
+    else:
+        entries[wsk] = _encode(form)
+    setattr(agenda, field, entries)
+    agenda.put()
+
+
+def setConference(p_key, wsck, cf):
+    _update(p_key, 'conferences', wsck, cf)
+
+
+def dropConference(p_key, wsck):
+    _update(p_key, 'conferences', wsck, None)
+
+
+def setSession(p_key, sessionKey, sf):
+    _update(p_key, 'sessions', sessionKey, sf)
+
+
+def invalidateOrganizer(p_key):
+    """Delete the agendas of everyone attending a conference organized by
+    the given profile.
+    """
+    for c_key in Conference.query(ancestor=p_key).iter(keys_only=True):
+        attenders = Profile.attendersOf(c_key)
+        batch = []
+        for p_key in attenders.iter(keys_only=True, batch_size=INVALIDATE_BATCH):
+            batch.append(agendaKey(p_key))
+            if len(batch) == INVALIDATE_BATCH:
+                ndb.delete_multi(batch)
+                batch = []
+        ndb.delete_multi(batch)
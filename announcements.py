@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+The "nearly sold out" announcement.
+
+Conferences with at least one and at most NEARLY_SOLD_OUT seats left are
+kept in a single NearlySoldOut entity, along with the announcement text
+built from their names. Registrations and new conferences report the
+seats they leave. The entity and the memcache copy of the text are only
+rewritten when a conference joins or leaves the set, which happens a few
+times per conference. Deciding that nothing changed costs one cached
+read.
+
+The hourly cron no longer builds the announcement. It reconciles the set:
+it re-checks the live seat counts of the members, and of the conferences
+whose stored count is in range, in case a report was lost.
+
+"""
+
+__author__ = 'Yu Lei'
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import NearlySoldOut
+from cache import MEMCACHE_ANNOUNCEMENTS_KEY
+import seats
+
+NEARLY_SOLD_OUT = 5
+
+
+def _setKey():
+    return ndb.Key(NearlySoldOut, 'current')
+
+
+def _members():
+    current = _setKey().get()
+    return (current and current.conferences) or {}
+
+
+def isNearlySoldOut(seatsLeft):
+    return seatsLeft is not None and 0 < seatsLeft <= NEARLY_SOLD_OUT
+
+
+def _format(conferences):
+    if not conferences:
+        return ""
+    return '%s %s' % (
+        'Last chance to attend! The following conferences '
+        'are nearly sold out:',
+        ', '.join(sorted(conferences.values())))
+
+
+@ndb.transactional()
+def _apply(changes):
+    """Apply {websafe key: name, or None to drop}; returns the new
+    announcement, or None if the set did not change.
+    """
+    current = _setKey().get() or NearlySoldOut(key=_setKey())
+    conferences = dict(current.conferences or {})
+    for wsck, name in changes.items():
+        if name is None:
+            conferences.pop(wsck, None)
+        else:
+            conferences[wsck] = name
+    if conferences == (current.conferences or {}):
+        return None
+    current.conferences = conferences
+    current.announcement = _format(conferences)
+    current.put()
+    return current.announcement
+
+
+def _changes(members, entries):
+    changes = {}
+    for c_key, name, seatsLeft in entries:
+        wsck = c_key.urlsafe()
+        if isNearlySoldOut(seatsLeft) and wsck not in members:
+            changes[wsck] = name
+        elif not isNearlySoldOut(seatsLeft) and wsck in members:
+            changes[wsck] = None
+    return changes
+
+
+def seatsChanged(entries):
+    """Record the seats left in conferences after registrations or
+    creation, given as [(conference key, name, seats left)].
+    """
+    # one seat away from the set: cannot have joined or left it
+    entries = [entry for entry in entries
+               if entry[2] is not None and entry[2] <= NEARLY_SOLD_OUT + 1]
+    if not entries:
+        return
+    changes = _changes(_members(), entries)
+    if changes:
+        announcement = _apply(changes)
+        if announcement is not None:
+            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+
+
+def getAnnouncement():
+    """Return the announcement, or an empty string."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if announcement is None:
+        current = _setKey().get()
+        announcement = (current and current.announcement) or ""
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+def reconcile():
+    """Bring the set in line with the live seat counts; returns the
+    announcement.
+    """
+    members = _members()
+    names = dict((ndb.Key(urlsafe=wsck), name) for wsck, name in members.items())
+    # stored counts lag the shards, but catch conferences never reported
+    candidates = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= NEARLY_SOLD_OUT,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+    for conf in candidates:
+        names[conf.key] = conf.name
+    # conferences without shards (deleted ones) count as not in range
+    seatsLeft = seats.getSeatsAvailableByKeys([(c_key, None) for c_key in names])
+    changes = _changes(members, [(c_key, name, seatsLeft[c_key])
+                                 for c_key, name in names.items()])
+    announcement = _apply(changes) if changes else None
+    if announcement is None:
+        announcement = _format(members)
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+def reset():
+    """Forget every member; used when all data is cleared."""
+    _setKey().delete()
+    memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
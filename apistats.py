@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""apistats.py
+
+Per-call instrumentation of the Endpoints API and the task handlers.
+
+middleware() wraps a WSGI application. For each request it records the
+wall time, the RPCs made by type, the entities the datastore returned,
+memcache hits and misses, and the response size. Each call is logged as
+one JSON line. The RPCs are seen through an apiproxy post-call hook and
+are attributed to the request running on the same thread.
+
+Calls are also added to rolling histograms in memcache, one set of
+counters per call name and five-minute window, batched per instance like
+the cache hit/miss counters. getStats() sums the windows of the last hour
+or less for the getApiStats endpoint.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+ENDPOINTS_PREFIX = '/_ah/spi/'
+HOOK_NAME = 'apistats'
+# upper bounds of the latency histogram buckets, in ms; the last is open
+BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+RPC_TYPES = ['get', 'query', 'put', 'delete', 'txn', 'memcache', 'taskqueue',
+             'urlfetch', 'other']
+DATASTORE_RPC_TYPES = {
+    'Get': 'get',
+    'RunQuery': 'query',
+    'Next': 'query',
+    'Put': 'put',
+    'Delete': 'delete',
+    'BeginTransaction': 'txn',
+    'Commit': 'txn',
+    'Rollback': 'txn',
+}
+COUNTERS = ['calls', 'errors', 'ms', 'entities', 'memcacheHits',
+            'memcacheMisses', 'bytes'] + ['rpc_' + t for t in RPC_TYPES] + \
+           ['bucket_%d' % i for i in range(len(BUCKETS_MS) + 1)]
+
+WINDOW_SECONDS = 300
+WINDOWS = 12
+MEMCACHE_STATS_KEY = "apiStats_%s_%d_%s"
+MEMCACHE_NAMES_KEY = "apiStatsNames"
+STATS_TIME = (WINDOWS + 1) * WINDOW_SECONDS
+STATS_FLUSH_EVERY = 50
+GET_BATCH = 1000
+
+_local = threading.local()
+# counter deltas not yet added to memcache, by memcache key
+_pending = {}
+_pendingCalls = [0]
+_pendingNames = set()
+_lock = threading.Lock()
+
+# - - - Recording calls - - - - - - - - - - - - - - - - - - - - -
+
+def _rpcType(service, call):
+    if service == 'datastore_v3':
+        return DATASTORE_RPC_TYPES.get(call, 'other')
+    if service in ('memcache', 'taskqueue', 'urlfetch'):
+        return service
+    return 'other'
+
+
+def _postCall(service, call, request, response, rpc=None, error=None):
+    """apiproxy hook: count an RPC of the request on this thread."""
+    record = getattr(_local, 'record', None)
+    if record is None or error is not None:
+        return
+    name = '%s.%s' % (service, call)
+    record['rpcs'][name] = record['rpcs'].get(name, 0) + 1
+    if service == 'datastore_v3' and call == 'Get':
+        record['entities'] += sum(1 for e in response.entity_list() if e.has_entity())
+    elif service == 'datastore_v3' and call in ('RunQuery', 'Next'):
+        record['entities'] += response.result_size()
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        record['memcacheHits'] += hits
+        record['memcacheMisses'] += request.key_size() - hits
+
+
+def _callName(environ):
+    path = environ.get('PATH_INFO', '')
+    if path.startswith(ENDPOINTS_PREFIX):
+        # e.g. ConferenceApi.getProfile
+        return path[len(ENDPOINTS_PREFIX):]
+    return path
+
+
+def middleware(app):
+    """Return a WSGI application recording each call made to `app`."""
+    def instrumented(environ, start_response):
+        # testbeds and new runtimes may swap the apiproxy; Append is a
+        # no-op when the hook is already there
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(HOOK_NAME, _postCall)
+        status = []
+
+        def recordingStartResponse(code, headers, exc_info=None):
+            status.append(int(code.split()[0]))
+            return start_response(code, headers, exc_info)
+
+        record = {'name': _callName(environ), 'rpcs': {}, 'entities': 0,
+                  'memcacheHits': 0, 'memcacheMisses': 0}
+        _local.record = record
+        start = time.time()
+        try:
+            body = list(app(environ, recordingStartResponse))
+        finally:
+            _local.record = None
+        record['ms'] = int(round((time.time() - start) * 1000))
+        record['bytes'] = sum(len(chunk) for chunk in body)
+        record['status'] = status[0] if status else 500
+        logging.info('api_call %s', json.dumps(record, sort_keys=True))
+        _count(record)
+        return body
+    return instrumented
+
+# - - - Rolling histograms - - - - - - - - - - - - - - - - - - - -
+
+def _bucket(ms):
+    for i, bound in enumerate(BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS_MS)
+
+
+def _key(name, window, counter):
+    return MEMCACHE_STATS_KEY % (name, window, counter)
+
+
+def _count(record):
+    window = int(time.time()) // WINDOW_SECONDS
+    deltas = {
+        'calls': 1,
+        'errors': 1 if record['status'] >= 500 else 0,
+        'ms': record['ms'],
+        'entities': record['entities'],
+        'memcacheHits': record['memcacheHits'],
+        'memcacheMisses': record['memcacheMisses'],
+        'bytes': record['bytes'],
+        'bucket_%d' % _bucket(record['ms']): 1,
+    }
+    for name, n in record['rpcs'].items():
+        counter = 'rpc_' + _rpcType(*name.split('.', 1))
+        deltas[counter] = deltas.get(counter, 0) + n
+    with _lock:
+        for counter, n in deltas.items():
+            if n:
+                key = _key(record['name'], window, counter)
+                _pending[key] = _pending.get(key, 0) + n
+        _pendingNames.add(record['name'])
+        _pendingCalls[0] += 1
+        flush = _pendingCalls[0] >= STATS_FLUSH_EVERY
+    if flush:
+        flushStats()
+
+
+def flushStats():
+    """Add this instance's pending counts to the memcache counters."""
+    with _lock:
+        deltas = dict(_pending)
+        names = set(_pendingNames)
+        _pending.clear()
+        _pendingNames.clear()
+        _pendingCalls[0] = 0
+    if not deltas:
+        return
+    listed = memcache.get(MEMCACHE_NAMES_KEY) or []
+    if names - set(listed):
+        # a name lost to a concurrent update is added by the next flush
+        memcache.set(MEMCACHE_NAMES_KEY, sorted(set(listed) | names))
+    memcache.offset_multi(deltas, initial_value=0, time=STATS_TIME)
+
+
+def _percentile(buckets, pct):
+    """Return the upper bound of the bucket holding the pct-th percentile,
+    or None if it is the open one.
+    """
+    total = sum(buckets)
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if total and seen * 100 >= total * pct:
+            return BUCKETS_MS[i] if i < len(BUCKETS_MS) else None
+    return None
+
+
+def getStats(minutes=WINDOWS * WINDOW_SECONDS // 60):
+    """Return [(call name, {counter: total}, [calls per bucket], p50 ms,
+    p99 ms)] over the windows covering the last `minutes`, busiest first.
+    """
+    flushStats()
+    count = max(1, min(WINDOWS, -(-minutes * 60 // WINDOW_SECONDS)))
+    now = int(time.time()) // WINDOW_SECONDS
+    windows = range(now - count + 1, now + 1)
+    names = memcache.get(MEMCACHE_NAMES_KEY) or []
+    keys = [_key(name, window, counter) for name in names
+            for window in windows for counter in COUNTERS]
+    values = {}
+    for i in range(0, len(keys), GET_BATCH):
+        values.update(memcache.get_multi(keys[i:i + GET_BATCH]))
+
+    stats = []
+    for name in names:
+        totals = dict((counter, sum(values.get(_key(name, window, counter), 0)
+                                    for window in windows))
+                      for counter in COUNTERS)
+        if not totals['calls']:
+            continue
+        buckets = [totals['bucket_%d' % i] for i in range(len(BUCKETS_MS) + 1)]
+        stats.append((name, totals, buckets,
+                      _percentile(buckets, 50), _percentile(buckets, 99)))
+    stats.sort(key=lambda stat: -stat[1]['calls'])
+    return stats
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""batching.py
+
+Coalescing of background work: featured-speaker checks, search index
+updates and confirmation emails.
+
+Work items go to pull queues, tagged by conference or by recipient. For
+each tag, at most one named push task per DIGEST_WINDOW seconds is
+scheduled, and it drains everything queued under that tag in one pass.
+A burst of 500 sessions for one conference therefore becomes one stats
+update, and a burst of confirmations for one organizer becomes one email.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import hashlib
+import json
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import speakers
+import textsearch
+
+SPEAKER_QUEUE = 'speaker-checks'
+EMAIL_QUEUE = 'email-digests'
+SEARCH_QUEUE = 'search-updates'
+DIGEST_WINDOW = 30
+LEASE_SECONDS = 60
+MAX_LEASE = 1000
+
+
+def _add(queue_name, tasks):
+    """Add tasks to a queue in batches of taskqueue.MAX_TASKS_PER_ADD."""
+    queue = taskqueue.Queue(queue_name)
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+def _scheduleDrains(url, tags):
+    """Schedule one drain task per tag for the current window; a drain that
+    is already scheduled for this window is left alone.
+    """
+    bucket = int(time.time()) // DIGEST_WINDOW
+    rpcs = []
+    for tag in set(tags):
+        name = 'drain-%s-%d' % (hashlib.md5(tag.encode('utf-8')).hexdigest(), bucket)
+        # run after the window closes, so it sees every item of the window
+        task = taskqueue.Task(name=name, url=url, params={'tag': tag},
+                              countdown=DIGEST_WINDOW)
+        rpcs.append(taskqueue.Queue().add_async(task))
+    for rpc in rpcs:
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+def _drain(queue_name, tag, handle):
+    """Lease all tasks queued under a tag, pass their payloads to `handle`
+    and delete them once it returns. If `handle` fails, the leases are
+    released before the error propagates, so the retry of the push task
+    can lease the same tasks again.
+    """
+    queue = taskqueue.Queue(queue_name)
+    while True:
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, MAX_LEASE, tag=tag)
+        if not tasks:
+            return
+        try:
+            handle([json.loads(task.payload) for task in tasks])
+        except Exception:
+            for task in tasks:
+                queue.modify_task_lease(task, 0)
+            raise
+        queue.delete_tasks(tasks)
+
+# - - - Featured speaker checks - - - - - - - - - - - - - - - - -
+
+def enqueueSpeakerChecks(checks):
+    """Queue [(websafeConferenceKey, speaker, session ids)] for counting."""
+    _add(SPEAKER_QUEUE, [taskqueue.Task(
+        method='PULL', tag=wsck,
+        payload=json.dumps({'speaker': speaker, 'sessionIds': session_ids}))
+        for wsck, speaker, session_ids in checks])
+    _scheduleDrains('/tasks/drain_speaker_checks',
+                    [wsck for wsck, speaker, session_ids in checks])
+
+
+def drainSpeakerChecks(wsck):
+    """Count every queued session of a conference in one stats update."""
+    c_key = ndb.Key(urlsafe=wsck)
+
+    def handle(checks):
+        speakerSessions = {}
+        for check in checks:
+            speakerSessions.setdefault(check['speaker'], []).extend(check['sessionIds'])
+        # checks for a deleted conference are simply dropped
+        if c_key.get():
+            speakers.addSessions(c_key, speakerSessions)
+
+    _drain(SPEAKER_QUEUE, wsck, handle)
+
+# - - - Search index updates - - - - - - - - - - - - - - - - - -
+
+def enqueueSearchUpdates(kind, updates):
+    """Queue [(websafe key, {token: weight})] for the search index."""
+    _add(SEARCH_QUEUE, [taskqueue.Task(
+        method='PULL', tag=kind,
+        payload=json.dumps({'key': wsk, 'terms': terms}))
+        for wsk, terms in updates])
+    if updates:
+        _scheduleDrains('/tasks/drain_search_updates', [kind])
+
+
+def drainSearchUpdates(kind):
+    """Apply every queued update of a kind in one index write."""
+    def handle(updates):
+        textsearch.applyUpdates(kind, [(u['key'], u['terms']) for u in updates])
+
+    _drain(SEARCH_QUEUE, kind, handle)
+
+# - - - Confirmation emails - - - - - - - - - - - - - - - - - - -
+
+def enqueueEmails(emails):
+    """Queue [(recipient, subject, body)] for the recipients' digests."""
+    _add(EMAIL_QUEUE, [taskqueue.Task(
+        method='PULL', tag=recipient,
+        payload=json.dumps({'subject': subject, 'body': body}))
+        for recipient, subject, body in emails])
+    _scheduleDrains('/tasks/send_email_digest',
+                    [recipient for recipient, subject, body in emails])
+
+
+def sendEmailDigest(recipient):
+    """Send everything queued for a recipient as one email."""
+    def handle(messages):
+        if len(messages) == 1:
+            subject, body = messages[0]['subject'], messages[0]['body']
+        else:
+            subject = 'Your conference updates (%d)' % len(messages)
+            body = '\r\n\r\n----\r\n\r\n'.join(
+                '%s\r\n\r\n%s' % (m['subject'], m['body']) for m in messages)
+        mail.send_mail(
+            'noreply@%s.appspotmail.com' % (
+                app_identity.get_application_id()),     # from
+            recipient,                                  # to
+            subject,                                    # subj
+            body                                        # body
+        )
+
+    _drain(EMAIL_QUEUE, recipient, handle)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""benchutil.py
+
+Helpers shared by the benchmarks: putting the App Engine SDK on the path,
+activating the testbed stubs, signing a user in for Endpoints methods,
+injecting latency into API calls, counting them, and standing in for the
+OAuth tokeninfo service.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import json
+import os
+import sys
+import threading
+import time
+import urlparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def setupSdk(sdk, app=ROOT):
+    """Put the App Engine SDK and the application on sys.path."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, app)
+
+
+def activateTestbed(app=ROOT):
+    """Activate the datastore, memcache and taskqueue stubs; returns the
+    testbed.
+    """
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    # fully consistent so counts read back after a run are exact
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=app)
+    return tb
+
+
+def signIn(email):
+    """Make endpoints.get_current_user() return a user with this email."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = email.split('@')[-1]
+
+
+def injectLatency(services, latency):
+    """Delay every call to the given API services by `latency` seconds.
+
+    Asynchronous calls run on their own threads, so RPCs a handler
+    overlaps also overlap in wall time, as they would in production.
+    """
+    from google.appengine.api import apiproxy_stub_map
+
+    for service in services:
+        stub = apiproxy_stub_map.apiproxy.GetStub(service)
+        apiproxy_stub_map.apiproxy.ReplaceStub(service, _LatencyStub(stub, latency))
+
+
+class _LatencyStub(object):
+    """Wraps an API stub, sleeping before each call."""
+
+    def __init__(self, stub, latency):
+        self.stub = stub
+        self.latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self.stub, name)
+
+    def MakeSyncCall(self, service, call, request, response, request_id=None):
+        time.sleep(self.latency)
+        self.stub.MakeSyncCall(service, call, request, response)
+
+    def CreateRPC(self):
+        return _ThreadedRPC(stub=self)
+
+
+def countRpcs(services):
+    """Count the calls made to the given API services and the bytes of
+    their responses; returns the RpcCounter.
+    """
+    from google.appengine.api import apiproxy_stub_map
+
+    counter = RpcCounter()
+    for service in services:
+        stub = apiproxy_stub_map.apiproxy.GetStub(service)
+        apiproxy_stub_map.apiproxy.ReplaceStub(service, _CountingStub(stub, counter))
+    return counter
+
+
+class RpcCounter(object):
+    """Calls and response bytes per service, since the last reset()."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.bytes = {}
+
+    def add(self, service, size):
+        with self._lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            self.bytes[service] = self.bytes.get(service, 0) + size
+
+
+class _CountingStub(object):
+    """Wraps an API stub, counting each call and its response size."""
+
+    def __init__(self, stub, counter):
+        self.stub = stub
+        self.counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self.stub, name)
+
+    def MakeSyncCall(self, service, call, request, response, request_id=None):
+        self.stub.MakeSyncCall(service, call, request, response)
+        self.counter.add(service, response.ByteSize())
+
+    def CreateRPC(self):
+        # asynchronous calls end up in MakeSyncCall too
+        from google.appengine.api import apiproxy_rpc
+        return apiproxy_rpc.RPC(stub=self)
+
+
+def fakeTokeninfo(tokens, latency=0):
+    """Answer urlfetch calls to the tokeninfo service from `tokens`, a dict
+    of token -> {'user_id': ..., 'expires_in': ...}; returns the stub.
+
+    Unknown tokens get the service's invalid_token error. While
+    stub.failures is above zero, each call fails with a 503 and
+    decrements it.
+    """
+    from google.appengine.api import apiproxy_stub_map
+
+    stub = _TokeninfoStub(tokens, latency)
+    if apiproxy_stub_map.apiproxy.GetStub('urlfetch'):
+        apiproxy_stub_map.apiproxy.ReplaceStub('urlfetch', stub)
+    else:
+        apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', stub)
+    return stub
+
+
+class _TokeninfoStub(object):
+    """urlfetch stub serving tokeninfo answers."""
+
+    def __init__(self, tokens, latency):
+        self.tokens = tokens
+        self.latency = latency
+        self.failures = 0
+        self.calls = 0
+
+    def MakeSyncCall(self, service, call, request, response, request_id=None):
+        time.sleep(self.latency)
+        self.calls += 1
+        params = urlparse.parse_qs(urlparse.urlparse(request.url()).query)
+        token = (params.get('id_token') or params.get('access_token') or [''])[0]
+        if self.failures > 0:
+            self.failures -= 1
+            status, body = 503, 'backend error'
+        elif token in self.tokens:
+            status, body = 200, json.dumps(self.tokens[token])
+        else:
+            status, body = 400, json.dumps({'error': 'invalid_token'})
+        response.set_statuscode(status)
+        response.set_content(body)
+        response.set_finalurl(request.url())
+
+    def CreateRPC(self):
+        from google.appengine.api import apiproxy_rpc
+        return apiproxy_rpc.RPC(stub=self)
+
+
+def _threadedRpcClass():
+    from google.appengine.api import apiproxy_rpc
+
+    class ThreadedRPC(apiproxy_rpc.RPC):
+        """RPC that is sent on a worker thread as soon as it is made."""
+
+        def _MakeCallImpl(self):
+            super(ThreadedRPC, self)._MakeCallImpl()
+            self._thread = threading.Thread(target=self._SendRequest)
+            self._thread.start()
+
+        def _WaitImpl(self):
+            self._thread.join()
+            return True
+
+    return ThreadedRPC
+
+
+_rpcClasses = []
+
+
+def _ThreadedRPC(stub):
+    # the class can only be defined once the SDK is importable
+    if not _rpcClasses:
+        _rpcClasses.append(_threadedRpcClass())
+    return _rpcClasses[0](stub=stub)
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of numbers."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""endpoint_latency.py
+
+Latency of the multi-RPC ConferenceApi endpoints under injected RPC
+latency, run against the local App Engine stubs.
+
+Every datastore, memcache and taskqueue call is delayed by --latency
+milliseconds, so an endpoint's time mostly shows how many RPCs it makes
+one after another. To compare before/after, run the same script against
+an older checkout with --app, e.g. one made with `git worktree add`.
+
+Usage:
+    python benchmarks/endpoint_latency.py --sdk ~/google_appengine \\
+        --latency 20 --calls 50 [--app /path/to/other/checkout]
+
+"""
+
+from __future__ import print_function
+
+__author__ = 'Yu Lei'
+
+import argparse
+import json
+import sys
+import time
+
+from benchutil import ROOT
+from benchutil import activateTestbed
+from benchutil import injectLatency
+from benchutil import percentile
+from benchutil import setupSdk
+from benchutil import signIn
+
+USER_EMAIL = 'bench@example.com'
+CONFERENCES_TO_ATTEND = 20
+
+
+def seed():
+    """Store a user attending CONFERENCES_TO_ATTEND conferences organized
+    by that same user; returns (conference keys, session keys).
+    """
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Profile
+    from models import Session
+
+    p_key = ndb.Key(Profile, USER_EMAIL)
+    c_keys = [ndb.Key(Conference, i + 1, parent=p_key)
+              for i in range(CONFERENCES_TO_ATTEND)]
+    confs = [Conference(key=c_key, name='Conference %d' % c_key.id(),
+                        organizerUserId=USER_EMAIL, maxAttendees=100,
+                        seatsAvailable=100) for c_key in c_keys]
+    sessions = [Session(parent=c_key, name='Session', speaker='Speaker',
+                        websafeConferenceKey=c_key.urlsafe()) for c_key in c_keys]
+    # websafe strings, which older checkouts store as they are and newer
+    # ones move into Profile.conferencesToAttend
+    profile = Profile(key=p_key, displayName='Bench', mainEmail=USER_EMAIL,
+                      conferenceKeysToAttend=[c_key.urlsafe() for c_key in c_keys])
+    ndb.put_multi(confs + [profile])
+    return c_keys, ndb.put_multi(sessions)
+
+
+def run(args):
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    from protorpc import message_types
+
+    import conference
+    from models import SessionForm
+
+    signIn(USER_EMAIL)
+    c_keys, s_keys = seed()
+    injectLatency(['datastore_v3', 'memcache', 'taskqueue'], args.latency / 1000.0)
+    # endpoints makes a service instance per request, and the instance
+    # caches the profile it looked up, so every call gets a fresh one
+
+    def getConference(i):
+        # flush so every call takes the datastore path
+        memcache.flush_all()
+        request = conference.CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=c_keys[i % len(c_keys)].urlsafe())
+        conference.ConferenceApi().getConference(request)
+
+    def getConferencesToAttend(i):
+        conference.ConferenceApi().getConferencesToAttend(message_types.VoidMessage())
+
+    def createSession(i):
+        conference.ConferenceApi().createSession(SessionForm(
+            name='Session %d' % i, speaker='Speaker %d' % i,
+            websafeConferenceKey=c_keys[i % len(c_keys)].urlsafe()))
+
+    def addSessionToWishlist(i):
+        request = conference.SEESION_REQUEST.combined_message_class(
+            sessionKey=s_keys[i % len(s_keys)].urlsafe())
+        conference.ConferenceApi().addSessionToWishlist(request)
+
+    results = {}
+    for name, call in [('getConference', getConference),
+                       ('getConferencesToAttend', getConferencesToAttend),
+                       ('createSession', createSession),
+                       ('addSessionToWishlist', addSessionToWishlist)]:
+        timings = []
+        for i in range(args.calls):
+            # no context cache, so repeated calls really reach the stubs
+            ndb.get_context().clear_cache()
+            start = time.time()
+            call(i)
+            timings.append((time.time() - start) * 1000)
+        results[name] = {'p50_ms': percentile(timings, 50),
+                         'p99_ms': percentile(timings, 99)}
+        print('%-24s p50 %7.1fms  p99 %7.1fms' % (
+            name, results[name]['p50_ms'], results[name]['p99_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'app': args.app, 'latency_ms': args.latency,
+                       'endpoints': results}, out, indent=2, sort_keys=True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--app', default=ROOT,
+                        help='application checkout to benchmark')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='milliseconds added to every RPC')
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupSdk(args.sdk, args.app)
+    tb = activateTestbed(args.app)
+    try:
+        return run(args)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""endpoint_suite.py
+
+Latency, datastore RPCs and bytes read of each ConferenceApi endpoint on
+synthetic datasets of growing size, run against the local App Engine
+stubs.
+
+For each size N the script stores N conferences, N sessions and N
+profiles. Each profile attends and wishlists a few of them. The script
+then calls every endpoint --calls times as the first profile, on random
+targets, with a fresh service instance and ndb context per call, as in
+production. It reports p50/p99 latency, and per call the datastore and
+memcache RPCs and the datastore response bytes.
+
+Before that, --cold-starts new processes each time what a new instance
+does before serving: importing main.py, importing the Endpoints service
+and answering the warmup request.
+
+With --baseline, the results are compared with an earlier --json output.
+The script exits with status 1 if any of those numbers grew by more than
+--tolerance.
+
+Usage:
+    python benchmarks/endpoint_suite.py --sdk ~/google_appengine \\
+        --sizes 1000,10000,100000 --calls 50 \\
+        [--json out.json] [--baseline base.json --tolerance 0.2]
+
+"""
+
+from __future__ import print_function
+
+__author__ = 'Yu Lei'
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import date
+from datetime import time as daytime
+from datetime import timedelta
+
+from benchutil import ROOT
+from benchutil import activateTestbed
+from benchutil import countRpcs
+from benchutil import percentile
+from benchutil import setupSdk
+from benchutil import signIn
+
+PUT_BATCH = 500
+CITIES = ['London', 'Paris', 'Berlin', 'Tokyo', 'Chicago', 'Sydney',
+          'Toronto', 'Madrid', 'Seoul', 'Austin']
+TOPICS = ['Web', 'Mobile', 'Cloud', 'Data', 'Security', 'Design',
+          'Python', 'Go', 'Machine Learning', 'DevOps']
+SESSION_TYPES = ['Lecture', 'Workshop', 'Keynote', 'Panel']
+# conferences attended and sessions wishlisted by each profile
+PER_PROFILE = 3
+# compared with the baseline; latencies also need to grow by --min-delta-ms
+METRICS = ['p50_ms', 'p99_ms', 'datastore_rpcs', 'datastore_bytes']
+
+
+def userEmail(i):
+    return 'user%d@example.com' % i
+
+
+def seed(size, rng):
+    """Store `size` conferences, sessions and profiles; returns
+    (conference keys, session keys, speaker names).
+    """
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Profile
+    from models import Session
+    from models import Speaker
+    import speakers
+    import textsearch
+
+    organizers = max(1, size // 100)
+    c_keys = [ndb.Key(Conference, i + 1, parent=ndb.Key(Profile, userEmail(i % organizers)))
+              for i in range(size)]
+    names = ['Speaker %d' % i for i in range(max(1, size // 20))]
+    entities = [Speaker(id=speakers.normalizeName(name), name=name) for name in names]
+    for i, c_key in enumerate(c_keys):
+        start = date(2016, 1, 1) + timedelta(days=rng.randrange(365))
+        seatsAvailable = rng.choice([10, 50, 100, 500])
+        entities.append(Conference(key=c_key, name='Conference %d' % i,
+            description='A conference about %s' % rng.choice(TOPICS),
+            organizerUserId=c_key.parent().id(),
+            topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+            startDate=start, month=start.month,
+            endDate=start + timedelta(days=2),
+            maxAttendees=seatsAvailable, seatsAvailable=seatsAvailable))
+    s_keys = [ndb.Key(Session, i + 1, parent=c_keys[i % size]) for i in range(size)]
+    for i, s_key in enumerate(s_keys):
+        speaker = rng.choice(names)
+        entities.append(Session(key=s_key, name='Session %d' % i,
+            highlights='All about %s' % rng.choice(TOPICS),
+            speaker=speaker,
+            speakerKey=ndb.Key(Speaker, speakers.normalizeName(speaker)),
+            duration=rng.choice([30, 45, 60, 90]),
+            typeOfSession=[rng.choice(SESSION_TYPES)],
+            date=date(2016, 6, 1) + timedelta(days=rng.randrange(3)),
+            startTime=daytime(rng.randrange(8, 18), rng.choice([0, 30])),
+            websafeConferenceKey=s_key.parent().urlsafe()))
+    for i in range(size):
+        entities.append(Profile(id=userEmail(i), displayName='User %d' % i,
+            mainEmail=userEmail(i), teeShirtSize='NOT_SPECIFIED',
+            conferencesToAttend=rng.sample(c_keys, min(PER_PROFILE, size)),
+            sessionsInWishlist=rng.sample(s_keys, min(PER_PROFILE, size))))
+    for i in range(0, len(entities), PUT_BATCH):
+        ndb.put_multi(entities[i:i + PUT_BATCH])
+        ndb.get_context().clear_cache()
+
+    # the search index, as the search-updates queue would have built it
+    for kind, model in textsearch.KINDS.items():
+        docs = [e for e in entities if isinstance(e, model)]
+        for i in range(0, len(docs), PUT_BATCH):
+            textsearch.applyUpdates(kind, [(e.key.urlsafe(), textsearch.documentTerms(kind, e))
+                                           for e in docs[i:i + PUT_BATCH]])
+            ndb.get_context().clear_cache()
+    return c_keys, s_keys, names
+
+
+def endpointCalls(c_keys, s_keys, names, rng):
+    """Return {endpoint name: prepare}, where prepare(api) does any
+    untimed setup and returns the call to time.
+    """
+    from protorpc import message_types
+
+    import conference
+    from models import ConferenceQueryForm
+    from models import ConferenceQueryForms
+
+    void = message_types.VoidMessage()
+
+    def conf():
+        return conference.CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=rng.choice(c_keys).urlsafe())
+
+    def unregister(api):
+        # register first, so there is something to undo
+        request = conf()
+        try:
+            conference.ConferenceApi().registerForConference(request)
+        except conference.ConflictException:
+            pass
+        return lambda: api.unregisterFromConference(request)
+
+    def plain(method, request=lambda: void):
+        def prepare(api):
+            message = request()
+            return lambda: getattr(api, method)(message)
+        return prepare
+
+    return {
+        'getProfile': plain('getProfile'),
+        'getConference': plain('getConference', conf),
+        'queryConferences': plain('queryConferences', lambda: ConferenceQueryForms(
+            filters=[ConferenceQueryForm(field='CITY', operator='EQ', value=rng.choice(CITIES)),
+                     ConferenceQueryForm(field='MONTH', operator='GT', value='6')],
+            pageSize=20)),
+        'searchConferences': plain('searchConferences',
+            lambda: conference.SEARCH_REQUEST.combined_message_class(
+                query=rng.choice(TOPICS), pageSize=20)),
+        'getConferencesCreated': plain('getConferencesCreated'),
+        'getConferencesToAttend': plain('getConferencesToAttend'),
+        'registerForConference': plain('registerForConference', conf),
+        'unregisterFromConference': unregister,
+        'getAttenderByConference': plain('getAttenderByConference',
+            lambda: conference.ATTENDERS_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=rng.choice(c_keys).urlsafe(), pageSize=20)),
+        'getConferenceSessions': plain('getConferenceSessions',
+            lambda: conference.SESSIONS_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=rng.choice(c_keys).urlsafe(), pageSize=20)),
+        'getSessionsBySpeaker': plain('getSessionsBySpeaker',
+            lambda: conference.SESSION_GET_BY_SPEAKER_REQUEST.combined_message_class(
+                speaker=rng.choice(names), pageSize=20)),
+        'addSessionToWishlist': plain('addSessionToWishlist',
+            lambda: conference.SEESION_REQUEST.combined_message_class(
+                sessionKey=rng.choice(s_keys).urlsafe())),
+        'getSessionsInWishlist': plain('getSessionsInWishlist'),
+        'getAnnouncement': plain('getAnnouncement'),
+    }
+
+
+def timeEndpoint(prepare, counter, args):
+    """Call an endpoint args.calls times; returns its row of results."""
+    import endpoints
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+
+    import conference
+
+    timings = []
+    calls = {}
+    datastore_bytes = 0
+    errors = 0
+    for i in range(args.warmup + args.calls):
+        # a new service instance and ndb context per call, as per request
+        call = prepare(conference.ConferenceApi())
+        ndb.get_context().clear_cache()
+        if args.flush_memcache:
+            memcache.flush_all()
+        counter.reset()
+        start = time.time()
+        try:
+            call()
+        except endpoints.ServiceException:
+            # e.g. registering twice; still a realistic call
+            errors += 1
+        elapsed = (time.time() - start) * 1000
+        if i < args.warmup:
+            continue
+        timings.append(elapsed)
+        for service, n in counter.calls.items():
+            calls[service] = calls.get(service, 0) + n
+        datastore_bytes += counter.bytes.get('datastore_v3', 0)
+    return {
+        'p50_ms': percentile(timings, 50),
+        'p99_ms': percentile(timings, 99),
+        'datastore_rpcs': calls.get('datastore_v3', 0) / float(args.calls),
+        'memcache_rpcs': calls.get('memcache', 0) / float(args.calls),
+        'datastore_bytes': datastore_bytes / float(args.calls),
+        'errors': errors,
+    }
+
+
+def runSize(size, args):
+    """Seed one dataset in fresh stubs and time every endpoint on it."""
+    import confindex
+
+    tb = activateTestbed(args.app)
+    try:
+        # the conference index of the previous size lives in this process
+        confindex._snapshot = None
+        rng = random.Random(size)
+        start = time.time()
+        c_keys, s_keys, names = seed(size, rng)
+        print('%d of each kind seeded in %.1fs' % (size, time.time() - start))
+        # as the warmup request of a new instance does
+        confindex.prime()
+
+        signIn(userEmail(0))
+        counter = countRpcs(['datastore_v3', 'memcache'])
+        row = {}
+        calls = endpointCalls(c_keys, s_keys, names, rng)
+        for name in sorted(calls):
+            if args.endpoints and name not in args.endpoints:
+                continue
+            row[name] = timeEndpoint(calls[name], counter, args)
+            print('  %-26s p50 %8.2fms  p99 %8.2fms  %5.1f datastore %5.1f memcache '
+                  'RPCs  %9.0f bytes read' % (name, row[name]['p50_ms'], row[name]['p99_ms'],
+                  row[name]['datastore_rpcs'], row[name]['memcache_rpcs'],
+                  row[name]['datastore_bytes']))
+        return row
+    finally:
+        tb.deactivate()
+
+
+def measureColdStart(args):
+    """Time what a new instance does before its first request: importing
+    the task handlers, importing the Endpoints service, and the warmup
+    request. Runs in a fresh process; prints the timings as JSON.
+    """
+    tb = activateTestbed(args.app)
+    try:
+        timings = {}
+        start = time.time()
+        import main
+        timings['import_main'] = (time.time() - start) * 1000
+        start = time.time()
+        import conference
+        timings['import_conference'] = (time.time() - start) * 1000
+        import webapp2
+        start = time.time()
+        webapp2.Request.blank('/_ah/warmup').get_response(main.app)
+        timings['warmup'] = (time.time() - start) * 1000
+        print(json.dumps(timings))
+    finally:
+        tb.deactivate()
+    return 0
+
+
+def coldStart(args):
+    """Return {step: {p50_ms, p99_ms}} over args.cold_starts new processes."""
+    runs = []
+    for i in range(args.cold_starts):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+            '--sdk', args.sdk, '--app', args.app, '--measure-cold-start'])
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    steps = sorted(runs[0]) if runs else []
+    row = dict((step, {'p50_ms': percentile([r[step] for r in runs], 50),
+                       'p99_ms': percentile([r[step] for r in runs], 99)})
+               for step in steps)
+    print('cold start over %d processes' % len(runs))
+    for step in steps:
+        print('  %-26s p50 %8.2fms  p99 %8.2fms' % (
+            step, row[step]['p50_ms'], row[step]['p99_ms']))
+    return row
+
+
+def _compareRow(label, row, before, args):
+    regressions = []
+    for name, numbers in sorted(row.items()):
+        if name not in before:
+            continue
+        for metric in METRICS:
+            old, new = before[name].get(metric), numbers.get(metric)
+            if old is None or new is None or new <= old * (1 + args.tolerance):
+                continue
+            if metric.endswith('_ms') and new - old < args.min_delta_ms:
+                continue
+            regressions.append('%s %s %s: %.2f -> %.2f' % (label, name, metric, old, new))
+    return regressions
+
+
+def compare(results, cold, baseline, args):
+    """Return descriptions of the numbers that grew past the tolerance."""
+    regressions = []
+    for size, row in sorted(results.items()):
+        regressions += _compareRow(str(size), row,
+            baseline.get('sizes', {}).get(str(size), {}), args)
+    regressions += _compareRow('cold start', cold, baseline.get('cold_start', {}), args)
+    return regressions
+
+
+def run(args):
+    cold = coldStart(args)
+    results = {}
+    for size in [int(n) for n in args.sizes.split(',') if n]:
+        results[size] = runSize(size, args)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'app': args.app, 'calls': args.calls,
+                       'flush_memcache': args.flush_memcache,
+                       'sizes': results, 'cold_start': cold},
+                      out, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, cold, json.load(f), args)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--app', default=ROOT,
+                        help='application checkout to benchmark')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated dataset sizes')
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed calls per endpoint before measuring')
+    parser.add_argument('--endpoints', type=lambda s: s.split(','),
+                        help='comma separated endpoints to run (default all)')
+    parser.add_argument('--flush-memcache', action='store_true',
+                        help='empty memcache before every call')
+    parser.add_argument('--cold-starts', type=int, default=5,
+                        help='new processes to time instance startup in')
+    parser.add_argument('--measure-cold-start', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier --json run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative growth over the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help='latency growth below this is never a regression')
+    args = parser.parse_args()
+
+    setupSdk(args.sdk, args.app)
+    if args.measure_cold_start:
+        return measureColdStart(args)
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
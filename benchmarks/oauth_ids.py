@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""oauth_ids.py
+
+Cost of resolving OAuth tokens to user ids (getUserId with id_type
+"oauth"), run against the local App Engine stubs and a stand-in for the
+tokeninfo service that answers after --latency milliseconds.
+
+The script times a lookup that has to ask the service, one answered by
+this instance's cache, and one answered by memcache. It then checks that
+an expired id is fetched again, that an invalid token resolves to '', and
+that an outage is retried without sleeping and then backed off.
+
+Usage:
+    python benchmarks/oauth_ids.py --sdk ~/google_appengine \\
+        --tokens 200 --latency 50 [--json out.json]
+
+"""
+
+from __future__ import print_function
+
+__author__ = 'Yu Lei'
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchutil import ROOT
+from benchutil import activateTestbed
+from benchutil import fakeTokeninfo
+from benchutil import percentile
+from benchutil import setupSdk
+
+
+def resolve(token):
+    """Call getUserId the way an Endpoints request with this token does."""
+    import utils
+
+    os.environ['HTTP_AUTHORIZATION'] = 'Bearer %s' % token
+    return utils.getUserId(None, id_type='oauth')
+
+
+def timeLookups(tokens, before=None):
+    from google.appengine.ext import ndb
+
+    timings = []
+    for token in tokens:
+        if before:
+            before()
+        ndb.get_context().clear_cache()
+        start = time.time()
+        resolve(token)
+        timings.append((time.time() - start) * 1000)
+    return {'p50_ms': percentile(timings, 50), 'p99_ms': percentile(timings, 99)}
+
+
+def check(ok, message, failures):
+    if not ok:
+        failures.append(message)
+
+
+def run(args):
+    from google.appengine.api import memcache
+
+    import tokeninfo
+
+    tokens = dict(('token-%d' % i, {'user_id': 'user%d' % i, 'expires_in': 3600})
+                  for i in range(args.tokens))
+    stub = fakeTokeninfo(tokens, args.latency / 1000.0)
+    names = sorted(tokens)
+    results = {}
+
+    tokeninfo.clearCache()
+    results['service'] = timeLookups(names)
+    service_calls = stub.calls
+    results['instance_cache'] = timeLookups(names)
+    results['memcache'] = timeLookups(names, before=tokeninfo.clearCache)
+    results['tokeninfo_calls'] = stub.calls
+
+    failures = []
+    check(service_calls == len(names),
+          '%d tokeninfo calls for %d tokens' % (service_calls, len(names)), failures)
+    check(stub.calls == service_calls, 'cached lookups called tokeninfo', failures)
+    check(resolve(names[0]) == tokens[names[0]]['user_id'], 'wrong user id', failures)
+
+    # an expired id is looked up again
+    tokens['short'] = {'user_id': 'short', 'expires_in': 1}
+    resolve('short')
+    time.sleep(1.1)
+    calls = stub.calls
+    check(resolve('short') == 'short' and stub.calls == calls + 1,
+          'expired id was not fetched again', failures)
+
+    # an unknown token is tried as id and as access token, then ''
+    calls = stub.calls
+    check(resolve('bogus') == '' and stub.calls == calls + 2,
+          'invalid token not rejected after two calls', failures)
+
+    # an outage is retried at once, then backed off without calls
+    memcache.flush_all()
+    tokeninfo.clearCache()
+    stub.failures = tokeninfo.FETCH_ATTEMPTS
+    start = time.time()
+    check(resolve(names[1]) == '', 'outage did not resolve to ""', failures)
+    results['outage_ms'] = (time.time() - start) * 1000
+    calls = stub.calls
+    start = time.time()
+    check(resolve(names[1]) == '' and stub.calls == calls,
+          'backoff still called tokeninfo', failures)
+    results['backed_off_ms'] = (time.time() - start) * 1000
+
+    for name in ('service', 'instance_cache', 'memcache'):
+        print('%-15s p50 %8.2fms  p99 %8.2fms' % (
+            name, results[name]['p50_ms'], results[name]['p99_ms']))
+    print('outage:         %.2fms, then %.2fms while backing off' % (
+        results['outage_ms'], results['backed_off_ms']))
+    for failure in failures:
+        print('FAILED', failure)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'app': args.app, 'tokens': args.tokens,
+                       'latency_ms': args.latency, 'results': results,
+                       'failures': failures}, out, indent=2, sort_keys=True)
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--app', default=ROOT,
+                        help='application checkout to benchmark')
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=50,
+                        help='tokeninfo response time in ms')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupSdk(args.sdk, args.app)
+    tb = activateTestbed(args.app)
+    try:
+        return run(args)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
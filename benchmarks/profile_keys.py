@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""profile_keys.py
+
+Profile size and read latency before and after moving the attended
+conferences and the wishlist from websafe-key strings to key lists, run
+against the local App Engine stubs.
+
+Profiles are first stored the old way, with the raw datastore API so the
+migrating put hook does not run. The script measures their stored size,
+get latency and membership tests, runs the migration mapper to the end,
+and measures again.
+
+Usage:
+    python benchmarks/profile_keys.py --sdk ~/google_appengine \\
+        --profiles 200 --conferences 50 --sessions 50 [--json out.json]
+
+"""
+
+from __future__ import print_function
+
+__author__ = 'Yu Lei'
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from benchutil import ROOT
+from benchutil import activateTestbed
+from benchutil import percentile
+from benchutil import setupSdk
+
+
+def seed(args):
+    """Store legacy profiles; returns (profile keys, conference keys)."""
+    from google.appengine.api import datastore
+    from google.appengine.ext import ndb
+
+    organizer = ndb.Key('Profile', 'organizer@example.com')
+    c_keys = [ndb.Key('Conference', i + 1, parent=organizer)
+              for i in range(args.conferences)]
+    s_keys = [ndb.Key('Session', i + 1, parent=c_keys[i % len(c_keys)])
+              for i in range(args.sessions)]
+    entities = []
+    for i in range(args.profiles):
+        entity = datastore.Entity('Profile', name='user%d@example.com' % i)
+        entity.update({
+            'displayName': 'User %d' % i,
+            'mainEmail': 'user%d@example.com' % i,
+            'teeShirtSize': 'NOT_SPECIFIED',
+            'conferenceKeysToAttend': [k.urlsafe() for k in c_keys],
+            'sessionKeysInWishlist': [k.urlsafe() for k in s_keys],
+        })
+        entities.append(entity)
+    datastore.Put(entities)
+    return [ndb.Key('Profile', e.key().name()) for e in entities], c_keys
+
+
+def measure(p_keys, c_keys, args):
+    """Return stored size, get latency and membership test cost."""
+    from google.appengine.api import datastore
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+
+    stored = datastore.Get([p_key.to_old_key() for p_key in p_keys])
+    sizes = [entity.ToPb().ByteSize() for entity in stored]
+
+    rng = random.Random(1)
+    timings = []
+    for i in range(args.reads):
+        memcache.flush_all()
+        ndb.get_context().clear_cache()
+        start = time.time()
+        rng.choice(p_keys).get()
+        timings.append((time.time() - start) * 1000)
+
+    # the old check was a scan of the websafe strings
+    profile = p_keys[0].get()
+    legacy = stored[0].get('conferenceKeysToAttend') or []
+    probes = [rng.choice(c_keys) for i in range(args.probes)]
+    start = time.time()
+    if legacy:
+        for c_key in probes:
+            c_key.urlsafe() in legacy
+    else:
+        for c_key in probes:
+            profile.attends(c_key)
+    membership_us = (time.time() - start) * 1e6 / len(probes)
+
+    return {
+        'entity_bytes_mean': sum(sizes) / float(len(sizes)),
+        'get_p50_ms': percentile(timings, 50),
+        'get_p99_ms': percentile(timings, 99),
+        'membership_us': membership_us,
+    }
+
+
+def run(args):
+    import migrations
+
+    p_keys, c_keys = seed(args)
+    before = measure(p_keys, c_keys, args)
+
+    start = time.time()
+    phase, cursor = migrations.PROFILE_KEY_PHASES[0], None
+    while phase:
+        phase, cursor = migrations.migrateProfileKeys(phase, cursor)
+    migration_s = time.time() - start
+    after = measure(p_keys, c_keys, args)
+
+    for name in sorted(before):
+        print('%-18s before %10.2f  after %10.2f' % (name, before[name], after[name]))
+    print('migration:         %.2fs for %d profiles' % (migration_s, len(p_keys)))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'app': args.app, 'profiles': args.profiles,
+                       'conferences': args.conferences, 'sessions': args.sessions,
+                       'before': before, 'after': after,
+                       'migration_s': migration_s}, out, indent=2, sort_keys=True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--app', default=ROOT,
+                        help='application checkout to benchmark')
+    parser.add_argument('--profiles', type=int, default=200)
+    parser.add_argument('--conferences', type=int, default=50,
+                        help='conferences each profile attends')
+    parser.add_argument('--sessions', type=int, default=50,
+                        help='sessions in each wishlist')
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--probes', type=int, default=10000)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupSdk(args.sdk, args.app)
+    tb = activateTestbed(args.app)
+    try:
+        return run(args)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
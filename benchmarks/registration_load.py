@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""registration_load.py
+
+Load test for conference registration against the local App Engine
+datastore and memcache stubs.
+
+Many threads register distinct users for one conference at the same time.
+The run reports throughput, registrations lost to transaction contention,
+and the oversell rate, i.e. attendees beyond the conference's capacity.
+Compare against `--shards 1` to see the effect of the sharded seat counter.
+
+Usage:
+    python benchmarks/registration_load.py --sdk ~/google_appengine \\
+        --seats 500 --users 1000 --threads 50 --shards 20
+
+"""
+
+from __future__ import print_function
+
+__author__ = 'Yu Lei'
+
+import argparse
+import sys
+import threading
+import time
+
+from benchutil import activateTestbed
+from benchutil import setupSdk
+
+
+def run(args):
+    from google.appengine.api import datastore_errors
+    from google.appengine.ext import ndb
+
+    import seats
+    from conference import ConferenceApi
+    from conference import ConflictException
+    from models import Conference
+    from models import Profile
+
+    seats.NUM_SHARDS = args.shards
+
+    # one conference and a pool of users wanting to attend it
+    c_key = ndb.Key(Conference, 1, parent=ndb.Key(Profile, 'organizer'))
+    conf = Conference(key=c_key, name='Load test', maxAttendees=args.seats,
+                      seatsAvailable=args.seats)
+    ndb.put_multi([conf] + seats.makeShards(c_key, args.seats))
+    p_keys = ndb.put_multi([Profile(id='user%d' % i, displayName='user%d' % i)
+                            for i in range(args.users)])
+
+    wsck = c_key.urlsafe()
+    counts = {'registered': 0, 'sold_out': 0, 'contention': 0}
+    lock = threading.Lock()
+
+    def worker(keys):
+        for p_key in keys:
+            try:
+                # the shard picking and retries of registerForConference, on
+                # a service instance per request, as endpoints makes them
+                ConferenceApi()._register(p_key, c_key, wsck)
+                outcome = 'registered'
+            except ConflictException:
+                outcome = 'sold_out'
+            except datastore_errors.TransactionFailedError:
+                outcome = 'contention'
+            with lock:
+                counts[outcome] += 1
+
+    threads = [threading.Thread(target=worker, args=(p_keys[i::args.threads],))
+               for i in range(args.threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    remaining = sum(shard.seats for shard in
+                    ndb.get_multi(seats._shardKeys(c_key)) if shard)
+    attendees = Profile.attendersOf(c_key).count()
+    oversold = max(0, attendees - args.seats)
+
+    print('shards:             %d' % args.shards)
+    print('seats / users:      %d / %d' % (args.seats, args.users))
+    print('elapsed:            %.2fs' % elapsed)
+    print('attempts/s:         %.1f' % (args.users / elapsed))
+    print('registrations/s:    %.1f' % (counts['registered'] / elapsed))
+    print('registered:         %d' % counts['registered'])
+    print('sold out:           %d' % counts['sold_out'])
+    print('contention failed:  %d' % counts['contention'])
+    print('attendees (stored): %d' % attendees)
+    print('seats remaining:    %d' % remaining)
+    print('oversell rate:      %.4f' % (float(oversold) / max(args.seats, 1)))
+    if attendees + remaining != args.seats:
+        print('WARNING: attendees + remaining seats != capacity')
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--seats', type=int, default=500)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--shards', type=int, default=20)
+    args = parser.parse_args()
+
+    setupSdk(args.sdk)
+    tb = activateTestbed()
+    try:
+        return run(args)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
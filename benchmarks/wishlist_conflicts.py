@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""wishlist_conflicts.py
+
+Cost of schedule conflict detection for users with large wishlists, run
+against the local App Engine stubs.
+
+For each wishlist size, a user wishlists that many sessions spread over a
+three day conference. The script times getWishlistConflicts, getMyAgenda
+and a conflict-checked addSessionToWishlist, and separately times
+schedule.findConflicts against comparing every pair of sessions.
+
+Usage:
+    python benchmarks/wishlist_conflicts.py --sdk ~/google_appengine \\
+        --sizes 100,300,1000 --calls 20 [--json out.json]
+
+"""
+
+from __future__ import print_function
+
+__author__ = 'Yu Lei'
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import date
+from datetime import time as daytime
+from datetime import timedelta
+
+from benchutil import ROOT
+from benchutil import activateTestbed
+from benchutil import percentile
+from benchutil import setupSdk
+from benchutil import signIn
+
+USER_EMAIL = 'bench@example.com'
+DAYS = 3
+
+
+def seed(size, rng):
+    """Store a conference with `size` sessions, all in the user's
+    wishlist; returns the session keys.
+    """
+    from google.appengine.ext import ndb
+    from models import Conference
+    from models import Profile
+    from models import Session
+
+    p_key = ndb.Key(Profile, USER_EMAIL)
+    c_key = ndb.Key(Conference, size, parent=p_key)
+    conf = Conference(key=c_key, name='Conference %d' % size,
+                      organizerUserId=USER_EMAIL, maxAttendees=10,
+                      seatsAvailable=10)
+    sessions = [Session(parent=c_key, name='Session %d' % i, speaker='Speaker',
+                        websafeConferenceKey=c_key.urlsafe(),
+                        date=date(2016, 6, 1) + timedelta(days=rng.randrange(DAYS)),
+                        startTime=daytime(rng.randrange(8, 18), rng.choice([0, 15, 30, 45])),
+                        duration=rng.choice([15, 30, 45, 60, 90]))
+                for i in range(size)]
+    s_keys = ndb.put_multi(sessions)
+    profile = Profile(key=p_key, displayName='Bench', mainEmail=USER_EMAIL,
+                      sessionsInWishlist=s_keys)
+    ndb.put_multi([conf, profile])
+    return s_keys
+
+
+def pairwise(sessions):
+    """The quadratic reference: compare every pair of sessions."""
+    import schedule
+
+    spans = [(schedule.interval(s), s) for s in sessions]
+    spans = [(span, s) for span, s in spans if span]
+    return [(a, b) for i, (span_a, a) in enumerate(spans)
+            for span_b, b in spans[i + 1:]
+            if span_a[0] < span_b[1] and span_b[0] < span_a[1]]
+
+
+def timeCalls(call, calls):
+    from google.appengine.ext import ndb
+
+    timings = []
+    for i in range(calls):
+        ndb.get_context().clear_cache()
+        start = time.time()
+        call(i)
+        timings.append((time.time() - start) * 1000)
+    return {'p50_ms': percentile(timings, 50), 'p99_ms': percentile(timings, 99)}
+
+
+def run(args):
+    from google.appengine.ext import ndb
+    from protorpc import message_types
+
+    import conference
+    import schedule
+
+    signIn(USER_EMAIL)
+    api = conference.ConferenceApi()
+    rng = random.Random(1)
+    results = {}
+    for size in [int(n) for n in args.sizes.split(',')]:
+        s_keys = seed(size, rng)
+        sessions = ndb.get_multi(s_keys)
+
+        def addChecked(i):
+            request = conference.SEESION_REQUEST.combined_message_class(
+                sessionKey=s_keys[i % size].urlsafe(), rejectConflicts=True)
+            try:
+                api.addSessionToWishlist(request)
+            except conference.ConflictException:
+                pass
+
+        row = {
+            'getWishlistConflicts': timeCalls(
+                lambda i: api.getWishlistConflicts(message_types.VoidMessage()), args.calls),
+            'getMyAgenda': timeCalls(
+                lambda i: api.getMyAgenda(message_types.VoidMessage()), args.calls),
+            'addSessionToWishlist(rejectConflicts)': timeCalls(addChecked, args.calls),
+            'findConflicts': timeCalls(lambda i: schedule.findConflicts(sessions), args.calls),
+            'pairwise': timeCalls(lambda i: pairwise(sessions), args.calls),
+        }
+        found, expected = len(schedule.findConflicts(sessions)), len(pairwise(sessions))
+        if found != expected:
+            print('findConflicts found %d pairs, pairwise %d' % (found, expected))
+            return 1
+        row['conflicts'] = found
+        results[size] = row
+
+        print('%d wishlisted sessions, %d overlapping pairs' % (size, found))
+        for name in sorted(row):
+            if name != 'conflicts':
+                print('  %-38s p50 %8.1fms  p99 %8.1fms' % (
+                    name, row[name]['p50_ms'], row[name]['p99_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'app': args.app, 'sizes': results}, out, indent=2, sort_keys=True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--app', default=ROOT,
+                        help='application checkout to benchmark')
+    parser.add_argument('--sizes', default='100,300,1000',
+                        help='comma separated wishlist sizes')
+    parser.add_argument('--calls', type=int, default=20)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    setupSdk(args.sdk, args.app)
+    tb = activateTestbed(args.app)
+    try:
+        return run(args)
+    finally:
+        tb.deactivate()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
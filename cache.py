@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Memcache-backed caches of serialized API responses, plus hit/miss
+counters for them.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import hashlib
+import json
+import threading
+import time
+
+from protorpc import protojson
+from google.appengine.api import memcache
+
+from models import ConferenceForm
+from models import ConferenceForms
+import seats
+
+CONFERENCE_FORM_CACHE = "conferenceForm"
+# bump when ConferenceForm changes shape so stale blobs are never decoded
+CONFERENCE_FORM_VERSION = 1
+MEMCACHE_CONFERENCE_FORM_KEY = "conferenceForm_v%d_%s"
+CONFERENCE_FORM_CACHE_TIME = 3600
+
+CONFERENCE_QUERY_CACHE = "conferenceQuery"
+CONFERENCE_QUERY_VERSION = 2
+MEMCACHE_CONFERENCE_QUERY_KEY = "conferenceQuery_v%d_g%d_%s"
+CONFERENCE_QUERY_CACHE_TIME = 300
+# bumped whenever conferences change; part of every query cache key
+MEMCACHE_CONFERENCE_GENERATION_KEY = "conferenceGeneration"
+
+SEARCH_CACHE = "search"
+SEARCH_VERSION = 1
+MEMCACHE_SEARCH_KEY = "search_v%d_g%d_%s_%s"
+SEARCH_CACHE_TIME = 300
+# bumped whenever the search index of a kind changes
+MEMCACHE_SEARCH_GENERATION_KEY = "searchGeneration_%s"
+
+# the nearly-sold-out announcement, read by getAnnouncement
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+
+CACHE_NAMES = [CONFERENCE_FORM_CACHE, CONFERENCE_QUERY_CACHE, SEARCH_CACHE]
+MEMCACHE_STATS_KEY = "cacheStats_%s_%s"
+STATS_FLUSH_EVERY = 100
+
+# hit/miss counts not yet added to the shared memcache counters
+_pendingStats = {}
+_statsLock = threading.Lock()
+
+# - - - Hit/miss counters - - - - - - - - - - - - - - - - - - - -
+
+def countLookup(name, hit):
+    """Count a cache hit or miss; flushed to memcache in batches."""
+    key = MEMCACHE_STATS_KEY % (name, 'hits' if hit else 'misses')
+    with _statsLock:
+        _pendingStats[key] = _pendingStats.get(key, 0) + 1
+        flush = sum(_pendingStats.values()) >= STATS_FLUSH_EVERY
+    if flush:
+        flushStats()
+
+
+def flushStats():
+    """Add this instance's pending counts to the memcache counters."""
+    with _statsLock:
+        deltas = dict(_pendingStats)
+        _pendingStats.clear()
+    if deltas:
+        memcache.offset_multi(deltas, initial_value=0)
+
+
+def getStats():
+    """Return [(cache name, hits, misses)] summed over all instances."""
+    flushStats()
+    keys = [MEMCACHE_STATS_KEY % (name, outcome)
+            for name in CACHE_NAMES for outcome in ('hits', 'misses')]
+    values = memcache.get_multi(keys)
+    return [(name,
+             values.get(MEMCACHE_STATS_KEY % (name, 'hits'), 0),
+             values.get(MEMCACHE_STATS_KEY % (name, 'misses'), 0))
+            for name in CACHE_NAMES]
+
+# - - - ConferenceForm - - - - - - - - - - - - - - - - - - - - -
+
+def _conferenceFormKey(c_key):
+    return MEMCACHE_CONFERENCE_FORM_KEY % (CONFERENCE_FORM_VERSION, c_key.urlsafe())
+
+
+def getConferenceForm(c_key):
+    """Return (ConferenceForm or None, seats available or None) for a
+    conference from a single memcache round trip.
+    """
+    form_key = _conferenceFormKey(c_key)
+    seats_key = seats.cacheKey(c_key)
+    values = memcache.get_multi([form_key, seats_key])
+    cf = None
+    if form_key in values:
+        cf = protojson.decode_message(ConferenceForm, values[form_key])
+    countLookup(CONFERENCE_FORM_CACHE, cf is not None)
+    return cf, values.get(seats_key)
+
+
+def setConferenceForm(c_key, cf):
+    """Cache the serialized ConferenceForm of a conference."""
+    memcache.set(_conferenceFormKey(c_key), protojson.encode_message(cf),
+                 time=CONFERENCE_FORM_CACHE_TIME)
+
+
+def deleteConferenceForms(c_keys):
+    """Drop the cached ConferenceForms of the given conferences."""
+    if c_keys:
+        memcache.delete_multi([_conferenceFormKey(c_key) for c_key in c_keys])
+
+# - - - queryConferences results - - - - - - - - - - - - - - - -
+
+def _generation(key):
+    """Return the current value of a generation counter, starting it if
+    needed.
+    """
+    generation = memcache.get(key)
+    if generation is None:
+        # start from the clock so an evicted counter never reuses old keys
+        generation = int(time.time())
+        if not memcache.add(key, generation):
+            generation = memcache.get(key) or generation
+    return generation
+
+
+def _bumpGeneration(key):
+    memcache.incr(key, initial_value=int(time.time()))
+
+
+def _conferenceGeneration():
+    """Return the current conference generation, starting one if needed."""
+    return _generation(MEMCACHE_CONFERENCE_GENERATION_KEY)
+
+
+def bumpConferenceGeneration():
+    """Invalidate every cached conference query result."""
+    _bumpGeneration(MEMCACHE_CONFERENCE_GENERATION_KEY)
+
+
+def _conferenceQueryKey(filters, pageSize, pageToken):
+    """Return the cache key of a query; filters are the dicts produced by
+    ConferenceApi._formatFilters, so fields, operators and values are
+    already normalized and typed. Their order does not matter.
+    """
+    canonical = json.dumps([
+        sorted((f['field'], f['operator'], f['value']) for f in filters),
+        pageSize, pageToken])
+    return MEMCACHE_CONFERENCE_QUERY_KEY % (
+        CONFERENCE_QUERY_VERSION, _conferenceGeneration(),
+        hashlib.sha1(canonical.encode('utf-8')).hexdigest())
+
+
+def getConferenceQuery(filters, pageSize, pageToken):
+    """Return (cache key, cached ConferenceForms or None) for a query."""
+    key = _conferenceQueryKey(filters, pageSize, pageToken)
+    value = memcache.get(key)
+    forms = None
+    if value is not None:
+        forms = protojson.decode_message(ConferenceForms, value)
+    countLookup(CONFERENCE_QUERY_CACHE, forms is not None)
+    return key, forms
+
+
+def setConferenceQuery(key, forms):
+    """Cache the results of a query under the key getConferenceQuery gave."""
+    memcache.set(key, protojson.encode_message(forms),
+                 time=CONFERENCE_QUERY_CACHE_TIME)
+
+# - - - Search results - - - - - - - - - - - - - - - - - - - - -
+
+def bumpSearchGeneration(kind):
+    """Invalidate every cached search of a kind."""
+    _bumpGeneration(MEMCACHE_SEARCH_GENERATION_KEY % kind)
+
+
+def getSearchResults(kind, tokens):
+    """Return (cache key, cached ranking or None) for a search; tokens are
+    the query as textsearch.tokenize normalized it.
+    """
+    canonical = u' '.join(tokens).encode('utf-8')
+    key = MEMCACHE_SEARCH_KEY % (
+        SEARCH_VERSION, _generation(MEMCACHE_SEARCH_GENERATION_KEY % kind),
+        kind, hashlib.sha1(canonical).hexdigest())
+    ranked = memcache.get(key)
+    countLookup(SEARCH_CACHE, ranked is not None)
+    return key, ranked
+
+
+def setSearchResults(key, ranked):
+    """Cache a ranking under the key getSearchResults gave."""
+    memcache.set(key, ranked, time=SEARCH_CACHE_TIME)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""cleardata.py
+
+clearAllData as a background job.
+
+Each kind is deleted BATCH_SIZE keys at a time, then every profile's
+conference and session lists are emptied page by page behind a cursor.
+The ClearJob is checkpointed after each batch, and each task stops after
+TIME_BUDGET seconds and queues the next, so a large datastore is cleared
+by a chain of short tasks that can fail and be retried at any point: a
+retried delete batch just finds the keys already gone.
+
+Memcache entries derived from the deleted entities are dropped as their
+conferences are deleted, and the shared ones (query and search
+generations, the conference index, the announcement) once the job is
+done.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Agenda
+from models import ClearJob
+from models import Conference
+from models import ConferenceStats
+from models import Profile
+from models import SearchDocument
+from models import SearchTerm
+from models import SeatShard
+from models import Session
+from models import Speaker
+import announcements
+import cache
+import confindex
+import seats
+import speakers
+import textsearch
+
+BATCH_SIZE = 500
+# well inside the push task deadline, so progress shows up often
+TIME_BUDGET = 60
+TASK_URL = '/tasks/clear_data'
+
+# kinds in deletion order; conferences go last so a session is never
+# left without its parent while the job runs
+DELETE_PHASES = [
+    ('Session', Session),
+    ('SeatShard', SeatShard),
+    ('ConferenceStats', ConferenceStats),
+    ('Speaker', Speaker),
+    ('SearchTerm', SearchTerm),
+    ('SearchDocument', SearchDocument),
+    ('Agenda', Agenda),
+    ('Conference', Conference),
+]
+PROFILE_PHASE = 'Profile'
+PHASES = [name for name, model in DELETE_PHASES] + [PROFILE_PHASE]
+
+
+def start():
+    """Create a ClearJob and queue its first task."""
+    job = ClearJob(phase=PHASES[0], counts={})
+    job.put()
+    _queueNext(job)
+    return job
+
+
+def getJob(job_id):
+    return ndb.Key(ClearJob, job_id).get()
+
+
+def run(job, time_budget=TIME_BUDGET):
+    """Clear batches until the job is done or the time budget runs out,
+    then queue the next task if there is work left.
+    """
+    started = time.time()
+    while job.phase and time.time() - started < time_budget:
+        if job.phase == PROFILE_PHASE:
+            _resetProfiles(job)
+        else:
+            _deleteBatch(job)
+        if not job.phase:
+            _finish()
+            job.status = 'done'
+        job.put()
+    if job.phase:
+        job.runs += 1
+        job.put()
+        _queueNext(job)
+
+
+def _queueNext(job):
+    # named after the run, so a retried task cannot fork the chain
+    try:
+        taskqueue.add(url=TASK_URL, params={'job': job.key.id()},
+                      name='clear-%d-%d' % (job.key.id(), job.runs))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _count(job, name, n):
+    counts = job.counts or {}
+    counts[name] = counts.get(name, 0) + n
+    job.counts = counts
+
+
+def _nextPhase(job):
+    following = PHASES.index(job.phase) + 1
+    job.phase = PHASES[following] if following < len(PHASES) else None
+    job.cursor = None
+
+
+def _deleteBatch(job):
+    model = dict(DELETE_PHASES)[job.phase]
+    keys = model.query().fetch(BATCH_SIZE, keys_only=True)
+    if not keys:
+        _nextPhase(job)
+        return
+    ndb.delete_multi(keys)
+    if job.phase == 'Conference':
+        _forgetConferences(keys)
+    _count(job, job.phase, len(keys))
+
+
+def _forgetConferences(c_keys):
+    """Drop the memcache entries kept per conference."""
+    cache.deleteConferenceForms(c_keys)
+    memcache.delete_multi(
+        [seats.cacheKey(c_key) for c_key in c_keys] +
+        [speakers.MEMCACHE_FEATURED_SPEAKER_KEY % c_key.urlsafe() for c_key in c_keys])
+
+
+def _resetProfiles(job):
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    profiles, next_cursor, more = Profile.query().fetch_page(
+        BATCH_SIZE, start_cursor=cursor)
+    for profile in profiles:
+        profile.conferencesToAttend = []
+        profile.sessionsInWishlist = []
+        profile.conferenceKeysToAttend = []
+        profile.sessionKeysInWishlist = []
+    ndb.put_multi(profiles)
+    _count(job, PROFILE_PHASE, len(profiles))
+    if more and next_cursor:
+        job.cursor = next_cursor.urlsafe()
+    else:
+        _nextPhase(job)
+
+
+def _finish():
+    """Drop the memcache entries shared by all conferences."""
+    cache.bumpConferenceGeneration()
+    confindex.reset()
+    for kind in textsearch.KINDS:
+        cache.bumpSearchGeneration(kind)
+    announcements.reset()
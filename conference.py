@@ -4,13 +4,17 @@ __author__ = 'Yu Lei'
 
 
 from datetime import datetime
+import httplib
 import json
+import logging
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 
 from models import Profile
 from models import ProfileMiniForm
@@ -20,7 +24,7 @@ from models import Session
 from models import SessionForm
 from models import SessionForms
 from models import ProfileForms
-from utils import getUserId
+from utils import getUserIdAsync
 from settings import WEB_CLIENT_ID
 from models import Conference
 from models import ConferenceForm
@@ -28,14 +32,42 @@ from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import BooleanMessage
-from models import ConflictException
-from google.appengine.api import memcache
-from models import StringMessage
+from models import CacheStatsForm
+from models import CacheStatsForms
+from models import WebsafeKeysForm
+from models import BatchErrorForm
+from models import ConferenceBatchForms
+from models import SessionBatchForms
+from models import SpeakerForm
+from models import SpeakerForms
+from models import ScheduleConflictForm
+from models import ScheduleConflictForms
+from models import AgendaForm
+from google.appengine.api import oauth
 from google.appengine.api import taskqueue
+from models import StringMessage
+from models import ClearJobForm
+from models import ApiStatsForm
+from models import ApiStatsForms
+from models import LatencyBucketForm
+from models import RpcCountForm
+import seats
+import cache
+import confindex
+import speakers
+import agenda
+import batching
+import schedule
+import textsearch
+import cleardata
+import announcements
+import apistats
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 100
 
 DEFAULTS = {
     "city": "Default City",
@@ -65,26 +97,86 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     typeOfSession=messages.StringField(1),
     websafeConferenceKey=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
 )
 
 SESSION_GET_BY_SPEAKER_REQUEST  = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker =messages.StringField(1),
-    
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
 )
 
+SPEAKER_ALIAS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    speaker=messages.StringField(1),
+    alias=messages.StringField(2),
+)
 
 SEESION_REQUEST  = endpoints.ResourceContainer(
     message_types.VoidMessage,
     sessionKey=messages.StringField(1),
+    # addSessionToWishlist only: refuse sessions overlapping the wishlist
+    rejectConflicts=messages.BooleanField(2),
+)
+
+API_STATS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    minutes=messages.IntegerField(1),
+)
+
+CLEAR_JOB_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    jobId=messages.IntegerField(1, required=True),
+)
+
+ATTENDERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+SESSION_ATTENDERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    sessionKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
 )
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
+class ConflictException(endpoints.ServiceException):
+    """ConflictException -- exception mapped to HTTP 409 response"""
+    http_status = httplib.CONFLICT
+
+
+class ServiceUnavailableException(endpoints.ServiceException):
+    """ServiceUnavailableException -- exception mapped to HTTP 503 response"""
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+
+
 @endpoints.api( name='conference',
                 version='v1',
                 allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID],
@@ -92,10 +184,129 @@ SEESION_REQUEST  = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    def __init__(self):
+        # futures of the profiles this request looked up, by user id;
+        # endpoints creates one service instance per request
+        self._profiles = {}
+
+# - - - Pagination - - - - - - - - - - - - - - - - - - - - - -
+
+    def _fetchPage(self, query, request, **options):
+        """Fetch one page of query results using the request's
+        pageSize/pageToken, returning (entities, nextPageToken). Extra
+        query options such as keys_only are passed on to fetch_page.
+        """
+        return self._fetchPageAsync(query, request, **options).get_result()
+
+    @ndb.tasklet
+    def _fetchPageAsync(self, query, request, **options):
+        """Tasklet version of _fetchPage."""
+        page_size = self._pageSize(request)
+        try:
+            cursor = Cursor(urlsafe=request.pageToken) if request.pageToken else None
+            entities, next_cursor, more = yield query.fetch_page_async(
+                page_size, start_cursor=cursor, **options)
+        except (datastore_errors.BadValueError,
+                datastore_errors.BadRequestError,
+                datastore_errors.BadArgumentError):
+            raise endpoints.BadRequestException("Invalid 'pageToken'.")
+
+        # only hand out a token when there is something left to fetch
+        next_token = next_cursor.urlsafe() if more and next_cursor else None
+        raise ndb.Return((entities, next_token))
+
+    def _offset(self, request):
+        """Return the position a search page starts at; search results are
+        ranked in memory, so their page tokens are plain offsets.
+        """
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid 'pageToken'.")
+        return offset
+
+    def _pageSize(self, request):
+        """Return the request's page size, defaulted and capped."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive.")
+        return min(page_size, MAX_PAGE_SIZE)
+
+# - - - Batch lookups - - - - - - - - - - - - - - - - - - - - -
+
+    def _getBatch(self, websafeKeys, kind):
+        """Resolve websafe keys of one kind with a single get_multi.
+
+        Returns (entities found, BatchErrorForms for the other keys);
+        duplicate keys are looked up and reported once.
+        """
+        if len(websafeKeys) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                'At most %d keys may be requested at once.' % MAX_BATCH_SIZE)
+
+        keys, wsks, errors = [], [], []
+        seen = set()
+        for wsk in websafeKeys:
+            if wsk in seen:
+                continue
+            seen.add(wsk)
+            try:
+                key = ndb.Key(urlsafe=wsk)
+            except Exception:
+                errors.append(BatchErrorForm(websafeKey=wsk, error='Invalid key'))
+                continue
+            if key.kind() != kind._get_kind():
+                errors.append(BatchErrorForm(websafeKey=wsk,
+                    error='Not a %s key' % kind._get_kind()))
+                continue
+            keys.append(key)
+            wsks.append(wsk)
+
+        found = []
+        for wsk, entity in zip(wsks, ndb.get_multi(keys)):
+            if entity is None:
+                errors.append(BatchErrorForm(websafeKey=wsk, error='Not found'))
+            else:
+                found.append(entity)
+        return found, errors
+
+    @endpoints.method(WebsafeKeysForm, ConferenceBatchForms,
+            path='conferences/batch',
+            http_method='POST', name='getConferencesBatch')
+    def getConferencesBatch(self, request):
+        """Return many conferences (by websafe key) in one call."""
+        conferences, errors = self._getBatch(request.websafeKeys, Conference)
+        seatsAvailable = seats.getSeatsAvailable(conferences, exact=False)
+
+        # get organizers, each one once
+        organisers = set(conf.organizerUserId for conf in conferences)
+        profiles = ndb.get_multi([ndb.Key(Profile, uid) for uid in organisers])
+        names = dict((profile.key.id(), profile.displayName)
+                     for profile in profiles if profile)
+
+        return ConferenceBatchForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId),
+                seatsAvailable[conf.key]) for conf in conferences],
+            errors=errors)
+
+    @endpoints.method(WebsafeKeysForm, SessionBatchForms,
+            path='sessions/batch',
+            http_method='POST', name='getSessionsBatch')
+    def getSessionsBatch(self, request):
+        """Return many sessions (by websafe key) in one call."""
+        sessions, errors = self._getBatch(request.websafeKeys, Session)
+        return SessionBatchForms(
+            items=[self._copySessionToForm(session) for session in sessions],
+            errors=errors)
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
+        # profiles from queries have not been through the get hook
+        prof.upgradeKeys()
         # copy relevant fields from Profile to ProfileForm
         pf = ProfileForm()
         for field in pf.all_fields():
@@ -103,6 +314,10 @@ class ConferenceApi(remote.Service):
                 # convert t-shirt string to Enum; just copy others
                 if field.name == 'teeShirtSize':
                     setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
+                elif field.name == 'conferenceKeysToAttend':
+                    pf.conferenceKeysToAttend = [k.urlsafe() for k in prof.conferencesToAttend]
+                elif field.name == 'sessionKeysInWishlist':
+                    pf.sessionKeysInWishlist = [k.urlsafe() for k in prof.sessionsInWishlist]
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
         pf.check_initialized()
@@ -110,25 +325,60 @@ class ConferenceApi(remote.Service):
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        return self._getProfileFromUserAsync().get_result()
+
+    def _getProfileFromUserAsync(self):
+        """Future version of _getProfileFromUser, so callers can overlap the
+        profile lookup with their own RPCs. The profile is looked up once
+        per request; ndb also caches it in memcache between requests.
+        """
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key = p_key,
+        return self._profileAsync(user, getUserIdAsync(user))
+
+    @ndb.tasklet
+    def _profileAsync(self, user, user_id_future):
+        # an OAuth user id may still be on its way from tokeninfo
+        user_id = yield user_id_future
+        if user_id not in self._profiles:
+            # reads first and only creates the Profile in a transaction, so
+            # two concurrent first requests cannot both store one
+            self._profiles[user_id] = Profile.get_or_insert_async(user_id,
                 displayName = user.nickname(),
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+        profile = yield self._profiles[user_id]
+        raise ndb.Return(profile)
+
+    def _cacheProfile(self, profile):
+        """Make later lookups in this request return `profile`; call after
+        storing it.
+        """
+        future = ndb.Future()
+        future.set_result(profile)
+        self._profiles[profile.key.id()] = future
 
-        return profile      # return Profile
+    def _cacheProfileOnCommit(self, profile):
+        """Cache a profile put in the current transaction once it commits."""
+        ndb.get_context().call_on_commit(lambda: self._cacheProfile(profile))
+
+
+    @ndb.transactional()
+    def _saveProfile(self, p_key, save_request):
+        """Copy the user-modifyable fields onto the profile; it is re-read
+        inside the transaction so a concurrent registration is kept.
+        """
+        prof = p_key.get()
+        for field in ('displayName', 'teeShirtSize'):
+            if hasattr(save_request, field):
+                val = getattr(save_request, field)
+                if val:
+                    setattr(prof, field, str(val))
+        prof.put()
+        self._cacheProfileOnCommit(prof)
+        return prof
 
 
     def _doProfile(self, save_request=None):
@@ -138,12 +388,15 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
-            for field in ('displayName', 'teeShirtSize'):
-                if hasattr(save_request, field):
-                    val = getattr(save_request, field)
-                    if val:
-                        setattr(prof, field, str(val))
-            prof.put()
+            oldDisplayName = prof.displayName
+            prof = self._saveProfile(prof.key, save_request)
+            # cached ConferenceForms carry the organizer's display name
+            if prof.displayName != oldDisplayName:
+                cache.deleteConferenceForms(
+                    Conference.query(ancestor=prof.key).fetch(keys_only=True))
+                # and so do the agendas of their attendees
+                taskqueue.add(url='/tasks/invalidate_agendas',
+                              params={'organizer': prof.key.urlsafe()})
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -164,21 +417,28 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        if conf.summary:
+            # precomputed when the conference was stored
+            cf = ConferenceForm(**json.loads(conf.summary))
+        else:
+            cf = ConferenceForm()
+            for field in cf.all_fields():
+                if hasattr(conf, field.name):
+                    # convert Date to date string; just copy others
+                    if field.name.endswith('Date'):
+                        setattr(cf, field.name, str(getattr(conf, field.name)))
+                    else:
+                        setattr(cf, field.name, getattr(conf, field.name))
+                elif field.name == "websafeKey":
+                    setattr(cf, field.name, conf.key.urlsafe())
+            cf.check_initialized()
         if displayName:
             setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+        # live count from the seat shards, if the caller looked it up
+        if seatsAvailable is not None:
+            cf.seatsAvailable = seatsAvailable
         return cf
 
     def _createConferenceObject(self, request):
@@ -187,7 +447,7 @@ class ConferenceApi(remote.Service):
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id_future = getUserIdAsync(user)
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -219,6 +479,7 @@ class ConferenceApi(remote.Service):
             setattr(request, "seatsAvailable", data["maxAttendees"])
 
         # make Profile Key from user ID
+        user_id = user_id_future.get_result()
         p_key = ndb.Key(Profile, user_id)
         # allocate new Conference ID with Profile key as parent
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
@@ -227,12 +488,22 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        # create Conference with its seat shards & return (modified) ConferenceForm
+        conf = Conference(**data)
+        ndb.put_multi([conf] + seats.makeShards(c_key, conf.seatsAvailable or 0))
+        cache.bumpConferenceGeneration()
+        confindex.addConferences([conf])
+        textsearch.index('conference', [conf])
+        announcements.seatsChanged([(c_key, conf.name, conf.seatsAvailable)])
+        # prime the getConference cache with the new conference
+        prof = p_key.get()
+        cache.setConferenceForm(c_key,
+            self._copyConferenceToForm(conf, getattr(prof, 'displayName', None)))
+        # confirmation goes out with the organizer's next email digest
+        batching.enqueueEmails([(user.email(),
+            'You created a new Conference!',
+            'Hi, you have created a following '
+            'conference:\r\n\r\n%s' % repr(request))])
 
         return request
 
@@ -249,61 +520,81 @@ class ConferenceApi(remote.Service):
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, one page at a time."""
+        filters = self._formatFilters(request.filters)
+
+        # popular filter combinations are answered from memcache
+        cache_key, forms = cache.getConferenceQuery(
+            filters, self._pageSize(request), request.pageToken)
+        if forms is not None:
+            seatsAvailable = seats.getSeatsAvailableByKeys(
+                [(ndb.Key(urlsafe=cf.websafeKey), cf.seatsAvailable)
+                 for cf in forms.items], exact=False)
+            for cf in forms.items:
+                cf.seatsAvailable = seatsAvailable[ndb.Key(urlsafe=cf.websafeKey)]
+            return forms
+
+        # any mix of filters is answered by the in-memory index, which hands
+        # back just the keys of this page
+        try:
+            c_keys, next_token = confindex.query(
+                filters, self._pageSize(request), request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'.")
+        except confindex.IndexUnavailableError as e:
+            # the index of a new instance is rebuilt by a task, not here
+            raise ServiceUnavailableException(str(e))
+        conferences = [conf for conf in
+                       ndb.get_multi([ndb.Key(urlsafe=wsk) for wsk in c_keys]) if conf]
+        seatsAvailable = seats.getSeatsAvailable(conferences, exact=False)
 
          # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "")
-            for conf in conferences]
+        forms = ConferenceForms(
+            items=[self._copyConferenceToForm(conf, "", seatsAvailable[conf.key])
+            for conf in conferences],
+            nextPageToken=next_token
         )
+        cache.setConferenceQuery(cache_key, forms)
+        return forms
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+            path='searchConferences',
+            http_method='GET', name='searchConferences')
+    def searchConferences(self, request):
+        """Full-text search over conference names, descriptions, topics
+        and cities, best matches first.
+        """
+        page_size = self._pageSize(request)
+        offset = self._offset(request)
+        wsks, more = textsearch.search('conference', request.query or '', offset, page_size)
+        conferences = [conf for conf in
+                       ndb.get_multi([ndb.Key(urlsafe=wsk) for wsk in wsks]) if conf]
+        seatsAvailable = seats.getSeatsAvailable(conferences, exact=False)
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf, "", seatsAvailable[conf.key])
+                for conf in conferences],
+            nextPageToken=str(offset + page_size) if more else None)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
         path='getConferencesCreated',
         http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        # make profile key
-        p_key = ndb.Key(Profile, getUserId(user))
-        # create ancestor query for this user
-        conferences = Conference.query(ancestor=p_key)
-        # get the user profile and display name
-        prof = p_key.get()
+        # get the user profile (making sure user is authed) and display name
+        prof = self._getProfileFromUser()
         displayName = getattr(prof, 'displayName')
+        # create ancestor query for this user
+        conferences = Conference.query(ancestor=prof.key).fetch()
+        seatsAvailable = seats.getSeatsAvailable(conferences, exact=False)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, displayName) for conf in conferences]
+            items=[self._copyConferenceToForm(conf, displayName, seatsAvailable[conf.key])
+                for conf in conferences]
         )
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
-
-
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
@@ -314,18 +605,18 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
+            # give numeric fields typed values
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter value for '%s' must be a number." % filtr["field"])
+
+            # inequalities may be combined on any number of fields, since
+            # confindex evaluates the filters itself
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return formatted_filters
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
         path='filterPlayground',
@@ -335,57 +626,104 @@ class ConferenceApi(remote.Service):
         # simple filter usage:
         q = q.filter(Conference.city == "London")
         q = q.filter(Conference.topics == "Medical Innovations")
+        conferences = q.fetch()
+        seatsAvailable = seats.getSeatsAvailable(conferences, exact=False)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf, "", seatsAvailable[conf.key])
+                for conf in conferences]
         )
 
-    @ndb.transactional(xg = True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
         prof = self._getProfileFromUser() # get user Profile
 
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        c_key = ndb.Key(urlsafe=wsck)
+        # the organizer's name goes into the user's agenda
+        organiser_future = c_key.parent().get_async()
+        conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        cf = self._copyConferenceToForm(
+            conf, getattr(organiser_future.get_result(), 'displayName', None))
+
+        # seat shards are created and read outside the registration transaction
+        seats.ensureShards(conf)
+        if reg:
+            retval = self._register(prof.key, conf.key, wsck, cf)
+        else:
+            retval = self._updateRegistration(prof.key, conf.key, wsck, reg, cf)
+        if retval:
+            try:
+                announcements.seatsChanged([(c_key, conf.name,
+                    seats.getSeatsAvailableByKey(c_key, None))])
+            except datastore_errors.Error:
+                # the registration stands; the announcement cron catches up
+                logging.exception('Announcement update failed for %s', wsck)
+        return BooleanMessage(data=retval)
+
+    def _register(self, p_key, c_key, wsck, cf=None):
+        """Register a user, trying the shards with seats left in turn;
+        call outside a transaction.
+        """
+        # a shard emptied since it was read is passed over for the next
+        for s_key in seats.shardsWithSeats(c_key) or [None]:
+            retval = self._updateRegistration(p_key, c_key, wsck, True, cf, s_key)
+            if retval is not None:
+                return retval
+        raise ConflictException(
+            "There are no seats available.")
+
+    @ndb.transactional(xg = True)
+    def _updateRegistration(self, p_key, c_key, wsck, reg=True, cf=None, s_key=None):
+        """Move one seat between the conference and the user's profile.
+
+        Only the profile, its agenda and a seat shard are written, so
+        registrations for the same conference do not contend on the
+        Conference entity group. A registration takes its seat from the
+        shard s_key; it returns None if that shard has none left by now.
+        """
+        prof = p_key.get()
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if prof.attends(c_key):
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # take away one seat, if any is left
+            if s_key is None:
                 raise ConflictException(
                     "There are no seats available.")
+            if not seats.takeSeat(c_key, s_key):
+                return None
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            # register user
+            prof.addConference(c_key)
+            agenda.setConference(p_key, wsck, cf)
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if prof.attends(c_key):
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                prof.removeConference(c_key)
+                agenda.dropConference(p_key, wsck)
+                seats.returnSeat(c_key)
                 retval = True
             else:
                 retval = False
 
         # write things back to the datastore & return
         prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        self._cacheProfileOnCommit(prof)
+        return retval
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
@@ -408,62 +746,111 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
-
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        wscks = [c_key.urlsafe() for c_key in prof.conferencesToAttend]
+        # usually a single read (or memcache hit) of the user's agenda
+        user_agenda = agenda.agendaKey(prof.key).get()
+        forms = user_agenda and agenda.conferenceForms(user_agenda, wscks)
+        if forms is None:
+            conferences = self._buildAgenda(prof)[0]
+            forms = [conferences[wsck] for wsck in wscks if conferences[wsck]]
+
+        # only the seat counts are looked up live
+        seatsAvailable = seats.getSeatsAvailableByKeys(
+            [(ndb.Key(urlsafe=cf.websafeKey), cf.seatsAvailable)
+             for cf in forms], exact=False)
+        for cf in forms:
+            cf.seatsAvailable = seatsAvailable[ndb.Key(urlsafe=cf.websafeKey)]
+        return ConferenceForms(items=forms)
+
+    def _buildAgenda(self, prof):
+        """Rebuild the profile's Agenda from the source entities; returns
+        ({websafeConferenceKey: ConferenceForm}, {sessionKey: SessionForm}),
+        with None for keys whose entity no longer exists.
+        """
+        conf_futures = ndb.get_multi_async(prof.conferencesToAttend)
+        session_futures = ndb.get_multi_async(prof.sessionsInWishlist)
+        conferences = [future.get_result() for future in conf_futures]
+        # organizers are the parents of their conferences' keys
+        organisers = ndb.get_multi(list(set(conf.key.parent() for conf in conferences if conf)))
+        names = dict((p.key, p.displayName) for p in organisers if p)
+        cfs = [(c_key.urlsafe(), self._copyConferenceToForm(conf, names.get(c_key.parent()))
+                if conf else None)
+               for c_key, conf in zip(prof.conferencesToAttend, conferences)]
+        sfs = [(s_key.urlsafe(), self._copySessionToForm(future.get_result())
+                if future.get_result() else None)
+               for s_key, future in zip(prof.sessionsInWishlist, session_futures)]
+        agenda.store(prof.key, cfs, sfs)
+        return dict(cfs), dict(sfs)
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:                                                                                                                                                               raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # a hot conference is served from memcache alone; seats are cached
+        # separately so registrations never invalidate the form
+        cf, seatsAvailable = cache.getConferenceForm(c_key)
+        if cf is None:
+            # get Conference object and its organizer (the key's parent)
+            # together; bail if not found
+            conf_future = c_key.get_async()
+            prof_future = c_key.parent().get_async()
+            conf = conf_future.get_result()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % request.websafeConferenceKey)
+            prof = prof_future.get_result()
+            cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName', None))
+            cache.setConferenceForm(c_key, cf)
+        if seatsAvailable is None:
+            seatsAvailable = seats.getSeatsAvailableByKey(c_key, cf.seatsAvailable)
+        cf.seatsAvailable = seatsAvailable
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
+
+    @endpoints.method(message_types.VoidMessage, CacheStatsForms,
+            path='cacheStats',
+            http_method='GET', name='getCacheStats')
+    def getCacheStats(self, request):
+        """Return hit/miss counts of the response caches."""
+        return CacheStatsForms(items=[
+            CacheStatsForm(name=name, hits=hits, misses=misses)
+            for name, hits, misses in cache.getStats()])
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+    def _requireAdmin():
+        """Raise ForbiddenException unless the caller is an app admin."""
+        try:
+            admin = oauth.is_current_user_admin(EMAIL_SCOPE)
+        except oauth.Error:
+            admin = False
+        if not admin:
+            raise endpoints.ForbiddenException('Admin access required')
+
+    @endpoints.method(API_STATS_REQUEST, ApiStatsForms,
+            path='apiStats',
+            http_method='GET', name='getApiStats')
+    def getApiStats(self, request):
+        """Return latency histograms and RPC counts per endpoint and task
+        handler over the last `minutes` (at most 60); admins only.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
-
+        self._requireAdmin()
+        items = []
+        for name, totals, buckets, p50, p99 in apistats.getStats(request.minutes or 60):
+            calls = float(totals['calls'])
+            items.append(ApiStatsForm(name=name, calls=totals['calls'],
+                errors=totals['errors'], meanMs=totals['ms'] / calls,
+                p50Ms=p50, p99Ms=p99,
+                rpcs=[RpcCountForm(type=t, count=totals['rpc_' + t])
+                      for t in apistats.RPC_TYPES if totals['rpc_' + t]],
+                entitiesPerCall=totals['entities'] / calls,
+                memcacheHits=totals['memcacheHits'],
+                memcacheMisses=totals['memcacheMisses'],
+                bytesPerCall=totals['bytes'] / calls,
+                histogram=[LatencyBucketForm(upperMs=bound, calls=n) for bound, n
+                           in zip(apistats.BUCKETS_MS + [None], buckets)]))
+        return ApiStatsForms(items=items)
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
@@ -472,10 +859,7 @@ class ConferenceApi(remote.Service):
         """Return Announcement from memcache."""
         # TODO 1
         # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
-        return StringMessage(data=announcement)
+        return StringMessage(data=announcements.getAnnouncement())
 
 # ----------------------Session-----------------------------------------
 
@@ -485,22 +869,29 @@ class ConferenceApi(remote.Service):
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id_future = getUserIdAsync(user)
 
         if not request.name:
             raise endpoints.BadRequestException("Session 'name' field required")
+        if not speakers.normalizeName(request.speaker or ''):
+            raise endpoints.BadRequestException("Session 'speaker' field required")
 
         #get cinference key
         wsck = request.websafeConferenceKey
-        # get conference object
+        # get conference object, allocating the new Session ID
+        # (with Conference key as parent) meanwhile
         c_key = ndb.Key(urlsafe=wsck)
-        conf = c_key.get()
+        conf_future = c_key.get_async()
+        ids_future = Session.allocate_ids_async(size=1, parent=c_key)
+        # wait for the user id only once those RPCs are under way
+        user_id = user_id_future.get_result()
+        conf = conf_future.get_result()
         # check that conference exists or not
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
         # check that user is owner
-        if conf.organizerUserId != getUserId(endpoints.get_current_user()):
+        if conf.organizerUserId != user_id:
             raise endpoints.ForbiddenException(
                 'You must be the organizer to create a session.')
 
@@ -511,26 +902,30 @@ class ConferenceApi(remote.Service):
             data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
         if data['startTime']:
             data['startTime'] = datetime.strptime(data['startTime'][:10],  "%H, %M").time()
-        # allocate new Session ID with Conference key as parent
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        # make Session key from ID
+        # make Session key from the allocated ID
+        s_id = ids_future.get_result()[0]
         s_key = ndb.Key(Session, s_id, parent=c_key)
         data['key'] = s_key
         data['websafeConferenceKey'] = wsck
         del data['sessionSafeKey']
+        # link the session to its speaker, creating the Speaker if new
+        speaker = speakers.resolveSpeakers([request.speaker])[request.speaker]
+        data['speakerKey'] = speaker.key
 
         #  save session into database
-        Session(**data).put()
-        # This task wil send a confirmation email to the owner 
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_session_email'
-        )
-        speaker = data['speaker']
-        taskqueue.add(
-            url='/tasks/check_featured_speaker',
-            params={'speaker': speaker, 'websafeConferenceKey': wsck}
-        )
+        session = Session(**data)
+        put_future = session.put_async()
+        # This wil send a confirmation email to the owner, batched with
+        # their other confirmations
+        batching.enqueueEmails([(user.email(),
+            'You created a new Session!',
+            'Hi, you have created a new Session in the following '
+            'conference:\r\n\r\n%s' % repr(request))])
+        put_future.get_result()
+        # only check the featured speaker once the session is stored; checks
+        # are drained per conference, not run per session
+        batching.enqueueSpeakerChecks([(wsck, speaker.name, [s_id])])
+        textsearch.index('session', [session])
         return request
 
     @endpoints.method(SessionForm, SessionForm,
@@ -555,24 +950,29 @@ class ConferenceApi(remote.Service):
         ss.check_initialized()
         return ss
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(SESSIONS_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions',
             http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Given a conference, returns all sessions."""
         # get the conference key
         wsck = request.websafeConferenceKey
-        # fetch the conference with the target key
-        conf = ndb.Key(urlsafe = wsck).get()
+        c_key = ndb.Key(urlsafe = wsck)
+        # create ancestor query for all sessions of this conference, in
+        # schedule order
+        sessions = Session.query(ancestor=c_key)
+        sessions = sessions.order(Session.date, Session.startTime, Session.key)
+        # fetch the conference alongside the query, in one round trip
+        conf_future = c_key.get_async()
+        page_future = self._fetchPageAsync(sessions, request)
         # check whether the conference exists or not
-        if not conf:
+        if not conf_future.get_result():
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
-         # create ancestor query for all key matches for this conference
-        sessions = Session.query()
-        Sessions = sessions.filter(Session.websafeConferenceKey == wsck)
+        sessions, next_token = page_future.get_result()
         # return set of SessionForm objects per conference
-        return SessionForms(items=[self._copySessionToForm(session) for session in Sessions])
+        return SessionForms(items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
 
     @endpoints.method(SESSION_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions/{typeOfSession}',
@@ -583,55 +983,106 @@ class ConferenceApi(remote.Service):
         wsck = request.websafeConferenceKey
         # get the type pf session we want
         typeOfSession = request.typeOfSession
-        # fetch the conference with the target key
-        conf = ndb.Key(urlsafe = wsck).get()
+        c_key = ndb.Key(urlsafe = wsck)
+        # create ancestor query for all sessions of this conference and type
+        # is what we want, in schedule order
+        sessions = Session.query(ancestor=c_key)
+        sessions = sessions.filter(Session.typeOfSession == typeOfSession)
+        sessions = sessions.order(Session.date, Session.startTime, Session.key)
+        # fetch the conference alongside the query, in one round trip
+        conf_future = c_key.get_async()
+        page_future = self._fetchPageAsync(sessions, request)
         # check whether the conference exists or not
-        if not conf:
+        if not conf_future.get_result():
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
-        # create ancestor query for all key matches for this conference and type is what we want
-        sessions = Session.query()
-        sessions = sessions.filter(Session.typeOfSession == typeOfSession, Session.websafeConferenceKey == wsck)
+        sessions, next_token = page_future.get_result()
         # return set of SessionForm objects per Session
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        return SessionForms(items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
 
     @endpoints.method(SESSION_GET_BY_SPEAKER_REQUEST, SessionForms,
             path='/sessions/{speaker}',
             http_method='GET', name='getSessionsBySpeaker') 
     def getSessionsBySpeaker(self, request):
         """Given a speaker, return all sessions given by this particular speaker, across all conferences."""
-        sessions = Session.query()
-        sessions = sessions.filter(Session.speaker == request.speaker)
+        # the name may be spelled differently or be an alias
+        s_key = speakers.findSpeakerKey(request.speaker or '')
+        if s_key is None:
+            return SessionForms(items=[])
+        # keys-only index scan, then one batch get of just this page
+        sessions = Session.query(Session.speakerKey == s_key)
+        sessions = sessions.order(Session.key)
+        s_keys, next_token = self._fetchPage(sessions, request, keys_only=True)
+        sessions = [session for session in ndb.get_multi(s_keys) if session]
         # return set of SessionForm objects
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])   
+        return SessionForms(items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=next_token)
+
+    @endpoints.method(SEARCH_REQUEST, SessionForms,
+            path='searchSessions',
+            http_method='GET', name='searchSessions')
+    def searchSessions(self, request):
+        """Full-text search over session names, highlights, speakers and
+        types, best matches first.
+        """
+        page_size = self._pageSize(request)
+        offset = self._offset(request)
+        wsks, more = textsearch.search('session', request.query or '', offset, page_size)
+        sessions = [session for session in
+                    ndb.get_multi([ndb.Key(urlsafe=wsk) for wsk in wsks]) if session]
+        return SessionForms(items=[self._copySessionToForm(session) for session in sessions],
+            nextPageToken=str(offset + page_size) if more else None)
+
+    @endpoints.method(SPEAKER_ALIAS_REQUEST, SpeakerForm,
+            path='speaker/alias',
+            http_method='POST', name='addSpeakerAlias')
+    def addSpeakerAlias(self, request):
+        """Record another name a speaker is known by; admins only, since
+        it changes the speaker results every user sees.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        self._requireAdmin()
+        if not speakers.normalizeName(request.alias or ''):
+            raise endpoints.BadRequestException("'alias' field required")
+        try:
+            speaker = speakers.addAlias(request.speaker or '', request.alias)
+        except ValueError as e:
+            raise ConflictException(str(e))
+        if speaker is None:
+            raise endpoints.NotFoundException(
+                'No speaker found with name: %s' % request.speaker)
+        return SpeakerForm(speaker=speaker.name, aliases=speaker.aliases)
 
-    @endpoints.method(CONF_GET_REQUEST, ProfileForms,
+    @endpoints.method(ATTENDERS_GET_REQUEST, ProfileForms,
             path='/getAttenderByConference/{websafeConferenceKey}',
             http_method='GET', name='getAttenderByConference') 
     def getAttenderByConference(self, request):
         """Given a Conference, return all attenders join this conferences."""
         wsck = request.websafeConferenceKey
-        profiles = Profile.query()
-        attenders = []
-        for pro in profiles:
-            if wsck in pro.conferenceKeysToAttend:
-                attenders.append(pro)
-        # return set of SessionForm objects
-        return ProfileForms(items=[self._copyProfileToForm(attender) for attender in attenders])    
+        # the repeated property is indexed, so this only touches the attenders
+        attenders = Profile.attendersOf(ndb.Key(urlsafe=wsck))
+        attenders = attenders.order(Profile.key)
+        attenders, next_token = self._fetchPage(attenders, request)
+        # return set of ProfileForm objects
+        return ProfileForms(items=[self._copyProfileToForm(attender) for attender in attenders],
+            nextPageToken=next_token)
 
-    @endpoints.method(SEESION_REQUEST, ProfileForms,
+    @endpoints.method(SESSION_ATTENDERS_GET_REQUEST, ProfileForms,
             path='/getAttenderBySession/{sessionKey}',
             http_method='GET', name='getAttenderBySession') 
     def getAttenderBySession(self, request):
         """Given a Session, return all attenders join this session."""
         sessionKey = request.sessionKey
-        profiles = Profile.query()
-        attenders = []
-        for pro in profiles:
-            if sessionKey in pro.sessionKeysInWishlist:
-                attenders.append(pro)
+        # the repeated property is indexed, so this only touches the attenders
+        attenders = Profile.wishersOf(ndb.Key(urlsafe=sessionKey))
+        attenders = attenders.order(Profile.key)
+        attenders, next_token = self._fetchPage(attenders, request)
         # return set of ProfileForm objects
-        return ProfileForms(items=[self._copyProfileToForm(attender) for attender in attenders])    
+        return ProfileForms(items=[self._copyProfileToForm(attender) for attender in attenders],
+            nextPageToken=next_token)
 
     @endpoints.method(SEESION_REQUEST, SessionForm,
             path="addSessionToWishlist",
@@ -640,32 +1091,87 @@ class ConferenceApi(remote.Service):
         """Add the session to the user's wishlist of sessions they are interested in attending"""
         #get session key
         sessionKey = request.sessionKey
-        # get session object
-        session = ndb.Key(urlsafe=sessionKey).get()
+        # get session object and user profile together
+        session_future = ndb.Key(urlsafe=sessionKey).get_async()
+        profile_future = self._getProfileFromUserAsync()
+        session = session_future.get_result()
         # check that session exists or not
         if not session:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % sessionKey)
 
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        profile = self._getProfileFromUser()
+        profile = profile_future.get_result()
         if not profile:
             raise endpoints.BadRequestException('Profile does not exist for user')
         # check if key and Session
-        if not type(ndb.Key(urlsafe=sessionKey).get()) == Session:
+        if not type(session) == Session:
             raise endpoints.NotFoundException('This key is not a Session instance')
+        if request.rejectConflicts:
+            clashes = schedule.conflictsWith(session, self._getWishlist(profile))
+            if clashes:
+                raise ConflictException(
+                    'Session overlaps wishlisted session: %s' % clashes[0].name)
         # add session to wishlist
-        if sessionKey not in profile.sessionKeysInWishlist:
-            try:
-                profile.sessionKeysInWishlist.append(sessionKey)
-                profile.put()
-            except Exception:
-                raise endpoints.InternalServerErrorException('Error in storing the wishlist')
+        try:
+            self._addToWishlist(profile.key, sessionKey, self._copySessionToForm(session))
+        except Exception:
+            raise endpoints.InternalServerErrorException('Error in storing the wishlist')
         return self._copySessionToForm(session)
 
+    @ndb.transactional()
+    def _addToWishlist(self, p_key, sessionKey, sf):
+        """Add a session to the profile's wishlist; the wishlist doubles as
+        the attender index of getAttenderBySession, so re-read the profile
+        inside the transaction to avoid losing concurrent additions.
+        """
+        profile = p_key.get()
+        s_key = ndb.Key(urlsafe=sessionKey)
+        if not profile.wishes(s_key):
+            profile.addSession(s_key)
+            profile.put()
+            agenda.setSession(p_key, sessionKey, sf)
+            self._cacheProfileOnCommit(profile)
+
+    def _getWishlist(self, profile):
+        """Return the stored sessions in a profile's wishlist."""
+        sessions = ndb.get_multi(profile.sessionsInWishlist)
+        return [session for session in sessions if session]
+
+    def _copyConflictsToForms(self, conflicts):
+        """Copy (earlier, later) session pairs to ScheduleConflictForms."""
+        return [ScheduleConflictForm(first=self._copySessionToForm(first),
+                                     second=self._copySessionToForm(second))
+                for first, second in conflicts]
+
+    @endpoints.method(message_types.VoidMessage, ScheduleConflictForms,
+                      path='getWishlistConflicts', http_method='GET',
+                      name='getWishlistConflicts')
+    def getWishlistConflicts(self, request):
+        """Return the pairs of wishlisted sessions that overlap in time."""
+        profile = self._getProfileFromUser()
+        if not profile:
+            raise endpoints.BadRequestException('Profile does not exist for user')
+        conflicts = schedule.findConflicts(self._getWishlist(profile))
+        return ScheduleConflictForms(items=self._copyConflictsToForms(conflicts))
+
+    @endpoints.method(message_types.VoidMessage, AgendaForm,
+                      path='getMyAgenda', http_method='GET',
+                      name='getMyAgenda')
+    def getMyAgenda(self, request):
+        """Return the wishlisted sessions in time order with their overlaps;
+        sessions without a date or start time come last.
+        """
+        profile = self._getProfileFromUser()
+        if not profile:
+            raise endpoints.BadRequestException('Profile does not exist for user')
+        sessions = self._getWishlist(profile)
+        timed = [session for start, end, session in schedule.sortByStart(sessions)]
+        timed_keys = set(session.key for session in timed)
+        untimed = [session for session in sessions if session.key not in timed_keys]
+        return AgendaForm(
+            items=[self._copySessionToForm(session) for session in timed + untimed],
+            conflicts=self._copyConflictsToForms(schedule.findConflicts(sessions)))
+
     @endpoints.method(message_types.VoidMessage,SessionForms, 
                       path='getSessionsInWishlist', http_method='GET',
                       name='getSessionsInWishlist')
@@ -674,11 +1180,15 @@ class ConferenceApi(remote.Service):
         profile = self._getProfileFromUser()
         if not profile:
             raise endpoints.BadRequestException('Profile does not exist for user')
-        # get all session keys
-        sessionkeys = [ndb.Key(urlsafe=sessionkey) for sessionkey in profile.sessionKeysInWishlist]
-        sessions = ndb.get_multi(sessionkeys)
+        # served from the user's agenda, rebuilt if it is out of date
+        sessionKeys = [s_key.urlsafe() for s_key in profile.sessionsInWishlist]
+        user_agenda = agenda.agendaKey(profile.key).get()
+        forms = user_agenda and agenda.sessionForms(user_agenda, sessionKeys)
+        if forms is None:
+            sessions = self._buildAgenda(profile)[1]
+            forms = [sessions[sessionKey] for sessionKey in sessionKeys if sessions[sessionKey]]
         # return set of SessionForm objects per conference
-        return SessionForms(items=[self._copySessionToForm(session) for session in sessions])
+        return SessionForms(items=forms)
 
     @endpoints.method(CONF_GET_REQUEST, StringMessage,
                       path='speaker/get_features',
@@ -691,40 +1201,54 @@ class ConferenceApi(remote.Service):
         if not c_key.get():
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
-        # Return memcache string for a particular conference
-        return StringMessage(data=memcache.get('featuredSpeaker_' + wsck) or "")
+        # Return the featured speaker maintained for a particular conference
+        return StringMessage(data=speakers.getFeaturedSpeaker(c_key))
+
+    @endpoints.method(CONF_GET_REQUEST, SpeakerForms,
+                      path='speaker/top',
+                      http_method='GET', name='getTopSpeakers')
+    def getTopSpeakers(self, request):
+        """Get the speakers with the most sessions in a conference"""
+        wsck = request.websafeConferenceKey
+        # get Conference object from request; bail if not found
+        c_key = ndb.Key(urlsafe=wsck)
+        if not c_key.get():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        return SpeakerForms(items=[SpeakerForm(speaker=speaker, sessions=count)
+            for speaker, count in speakers.getTopSpeakers(c_key)])
 
 
-    @endpoints.method(message_types.VoidMessage,BooleanMessage, 
+    def _copyClearJobToForm(self, job):
+        """Copy relevant fields from ClearJob to ClearJobForm."""
+        counts = job.counts or {}
+        return ClearJobForm(jobId=job.key.id(), status=job.status,
+            phase=job.phase,
+            deleted=sum(n for name, n in counts.items()
+                        if name != cleardata.PROFILE_PHASE),
+            profilesReset=counts.get(cleardata.PROFILE_PHASE, 0))
+
+
+    @endpoints.method(message_types.VoidMessage, ClearJobForm,
                       path='clearAllData', http_method='GET',
                       name='clearAllData')
     def clearAllData(self,request):
-        """Clear all the data saved."""
-        ndb.delete_multi(Session.query().fetch(keys_only = True))
-        ndb.delete_multi(Conference.query().fetch(keys_only = True))
-        profiles = Profile.query()
-        for profile in profiles:
-            profile.conferenceKeysToAttend = []
-            profile.sessionKeysInWishlist = []
-            profile.put()
-        return  BooleanMessage(data=True)
+        """Start clearing all the data saved; returns the job to poll."""
+        return self._copyClearJobToForm(cleardata.start())
 
-    @staticmethod
-    def _cacheFeaturedSpeaker(wsck, speaker):
-        """Get Featured Speaker & assign to memcache;"""
-        # get Conference object from request; bail if not found
-        c_key = ndb.Key(urlsafe=wsck)
-        if not c_key.get():
+
+    @endpoints.method(CLEAR_JOB_GET_REQUEST, ClearJobForm,
+                      path='clearAllData/{jobId}', http_method='GET',
+                      name='getClearAllDataStatus')
+    def getClearAllDataStatus(self, request):
+        """Return the progress of a clearAllData job."""
+        job = cleardata.getJob(request.jobId)
+        if not job:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % wsck)
-        # Get sessions for conference and particular speaker and return list
-        s_query = Session.query(ancestor=c_key)
-        s_query = s_query.filter(Session.speaker == speaker)
-        s_query = s_query.order(Session.date)
-        s_query = s_query.order(Session.startTime)
-        return s_query
+                'No clear job found with id: %s' % request.jobId)
+        return self._copyClearJobToForm(job)
 
 # TODO
 
 # registers API
-api = endpoints.api_server([ConferenceApi]) 
+api = apistats.middleware(endpoints.api_server([ConferenceApi])) 
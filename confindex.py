@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+"""confindex.py
+
+In-memory secondary index answering queryConferences.
+
+The datastore allows inequality filters on one property per query and
+needs a composite index per filter combination. Instead, every instance
+keeps a columnar Snapshot of the filterable fields of all conferences:
+for each field, a map from value to a bitset (a Python long) of the rows
+holding it, plus the field's values in sorted order. A conjunction of any
+filters is then a few bisects and bitwise ANDs.
+
+Snapshots are kept current by a change log in memcache. Writers add one
+numbered change per batch of new conferences; an instance compares its
+sequence number with the log's on every query and replays what it missed.
+The whole snapshot is also stored in memcache, compressed and chunked, so
+a new instance loads it instead of scanning the datastore. A gap in the
+log, e.g. a change not stored yet or evicted, never stalls a query: the
+instance serves the snapshot it has and queues a task, which brings the
+stored snapshot up to date, from the datastore if it has to. Only a
+warmup request scans the datastore itself, when no snapshot is stored;
+an instance that got no warmup answers IndexUnavailableError until the
+task has stored one.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import base64
+import bisect
+import json
+import logging
+import threading
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+from models import Conference
+
+INDEX_FIELDS = ['city', 'topics', 'month', 'maxAttendees']
+
+MEMCACHE_SEQUENCE_KEY = "confIndexSequence"
+MEMCACHE_CHANGE_KEY = "confIndexChange_%d"
+MEMCACHE_SNAPSHOT_KEY = "confIndexSnapshot"
+MEMCACHE_SNAPSHOT_CHUNK_KEY = "confIndexSnapshot_%d_%d"
+# changes are kept long enough for every live instance to replay them
+CHANGE_CACHE_TIME = 3600
+# beyond this many missed changes, rebuilding is cheaper than replaying
+MAX_REPLAY = 500
+# store the snapshot again after this many replayed changes
+STORE_EVERY = 100
+CHUNK_BYTES = 900 * 1024
+REBUILD_BATCH_SIZE = 500
+REBUILD_URL = '/tasks/rebuild_conference_index'
+# a change missing now is usually stored a moment later
+REBUILD_DELAY = 10
+
+# this instance's snapshot; queries and updates hold _lock
+_snapshot = None
+_lock = threading.Lock()
+# the latest sequence this instance queued a rebuild for
+_rebuildQueued = [None]
+
+
+class IndexUnavailableError(Exception):
+    """No snapshot is available to answer a query yet."""
+
+
+class Snapshot(object):
+    """Columnar copy of the INDEX_FIELDS of every conference."""
+
+    def __init__(self, sequence=0):
+        self.sequence = sequence
+        self.rowIds = {}        # websafe key -> row id
+        self.keys = []          # row id -> websafe key
+        self.names = []         # row id -> name
+        self.values = []        # row id -> {field: value or list of values}
+        self.live = 0           # bitset of every row
+        self.columns = dict((field, {}) for field in INDEX_FIELDS)
+        self._sortedValues = {}
+        self._order = None      # [(name, websafe key, row id)] of live rows
+
+    def upsert(self, row):
+        """Add or replace one [websafe key, name, values] row."""
+        wsk, name, values = row
+        rid = self.rowIds.get(wsk)
+        if rid is None:
+            rid = len(self.keys)
+            self.rowIds[wsk] = rid
+            self.keys.append(wsk)
+            self.names.append(name)
+            self.values.append({})
+            self._order = None
+        else:
+            self._setBits(rid, self.values[rid], False)
+            if self.names[rid] != name:
+                self.names[rid] = name
+                self._order = None
+        self.values[rid] = values
+        self._setBits(rid, values, True)
+        self.live |= 1 << rid
+
+    def _setBits(self, rid, values, on):
+        bit = 1 << rid
+        for field, value in values.items():
+            column = self.columns[field]
+            for v in (value if isinstance(value, list) else [value]):
+                if v is None:
+                    continue
+                bits = column.get(v, 0)
+                if on:
+                    column[v] = bits | bit
+                elif bits & ~bit:
+                    column[v] = bits & ~bit
+                else:
+                    column.pop(v, None)
+                # the sorted values only change when a value comes or goes
+                if not bits or v not in column:
+                    self._sortedValues.pop(field, None)
+
+    def rows(self):
+        """Return the live rows, as upsert takes them."""
+        return [[self.keys[rid], self.names[rid], self.values[rid]]
+                for rid in _bitsToRows(self.live)]
+
+    def _sorted(self, field):
+        if field not in self._sortedValues:
+            self._sortedValues[field] = sorted(self.columns[field])
+        return self._sortedValues[field]
+
+    def _sortedRows(self):
+        if self._order is None:
+            self._order = sorted((self.names[rid], self.keys[rid], rid)
+                                 for rid in _bitsToRows(self.live))
+        return self._order
+
+    def _match(self, field, operator, value):
+        """Return the bitset of rows with a value satisfying the filter;
+        like the datastore, a list matches if any of its values does.
+        """
+        column = self.columns[field]
+        if operator == '=':
+            return column.get(value, 0)
+        values = self._sorted(field)
+        if operator == '>':
+            selected = values[bisect.bisect_right(values, value):]
+        elif operator == '>=':
+            selected = values[bisect.bisect_left(values, value):]
+        elif operator == '<':
+            selected = values[:bisect.bisect_left(values, value)]
+        elif operator == '<=':
+            selected = values[:bisect.bisect_right(values, value)]
+        else:
+            selected = [v for v in values if v != value]
+        bits = 0
+        for v in selected:
+            bits |= column[v]
+        return bits
+
+    def query(self, filters, pageSize, after=None):
+        """Return (websafe keys, last (name, key) or None) for one page of
+        the conferences matching every filter, ordered by name then key;
+        `after` is the last (name, key) of the previous page.
+        """
+        matches = None
+        if filters:
+            bits = self.live
+            for f in filters:
+                bits &= self._match(f['field'], f['operator'], f['value'])
+            matches = set(_bitsToRows(bits))
+        # rows are sorted once per snapshot; a page walks them from `after`
+        order = self._sortedRows()
+        start = 0
+        if after:
+            # past every row id, so the row named by `after` is skipped
+            start = bisect.bisect_right(order, (after[0], after[1], len(self.keys)))
+        page = []
+        more = False
+        for i in xrange(start, len(order)):
+            name, wsk, rid = order[i]
+            if matches is not None and rid not in matches:
+                continue
+            if len(page) == pageSize:
+                more = True
+                break
+            page.append((name, wsk))
+        return [wsk for name, wsk in page], (page[-1] if more else None)
+
+
+def _bitsToRows(bits):
+    """Return the positions of the set bits, lowest first."""
+    # bin() runs in C, so only the set bits cost Python steps
+    digits = bin(bits)[:1:-1]
+    rows = []
+    rid = digits.find('1')
+    while rid >= 0:
+        rows.append(rid)
+        rid = digits.find('1', rid + 1)
+    return rows
+
+
+def _row(conf):
+    return [conf.key.urlsafe(), conf.name,
+            dict((field, getattr(conf, field)) for field in INDEX_FIELDS)]
+
+# - - - Change log - - - - - - - - - - - - - - - - - - - - - - -
+
+def _logChange(change):
+    sequence = memcache.incr(MEMCACHE_SEQUENCE_KEY, initial_value=int(time.time()))
+    if sequence is None:
+        logging.warning('Could not log conference index change')
+        return
+    memcache.set(MEMCACHE_CHANGE_KEY % sequence, json.dumps(change),
+                 time=CHANGE_CACHE_TIME)
+
+
+def addConferences(confs):
+    """Record new or changed conferences for every instance's snapshot."""
+    if confs:
+        _logChange({'upsert': [_row(conf) for conf in confs]})
+
+
+def reset():
+    """Record that every conference was deleted."""
+    _logChange({'reset': True})
+
+
+def _apply(snapshot, change):
+    if change.get('reset'):
+        fresh = Snapshot(snapshot.sequence)
+        snapshot.__dict__.update(fresh.__dict__)
+    for row in change.get('upsert', []):
+        snapshot.upsert(row)
+
+
+def _replay(snapshot, sequence):
+    """Apply changes up to `sequence`, stopping at the first one missing
+    from memcache; False if `sequence` was not reached.
+    """
+    if snapshot.sequence > sequence or sequence - snapshot.sequence > MAX_REPLAY:
+        return False
+    keys = [MEMCACHE_CHANGE_KEY % s for s in range(snapshot.sequence + 1, sequence + 1)]
+    changes = memcache.get_multi(keys)
+    for key in keys:
+        if key not in changes:
+            return False
+        _apply(snapshot, json.loads(changes[key]))
+        snapshot.sequence += 1
+    return True
+
+# - - - Loading and storing snapshots - - - - - - - - - - - - - -
+
+def _store(snapshot):
+    """Store a snapshot in memcache, split into chunks."""
+    blob = zlib.compress(json.dumps(snapshot.rows()))
+    chunks = [blob[i:i + CHUNK_BYTES] for i in range(0, len(blob), CHUNK_BYTES)]
+    values = dict((MEMCACHE_SNAPSHOT_CHUNK_KEY % (snapshot.sequence, i), chunk)
+                  for i, chunk in enumerate(chunks))
+    # chunks first, so the pointer never names chunks that are not there
+    if not memcache.set_multi(values):
+        memcache.set(MEMCACHE_SNAPSHOT_KEY, (snapshot.sequence, len(chunks)))
+
+
+def _storedSequence():
+    """Return the sequence of the snapshot stored in memcache, or None."""
+    stored = memcache.get(MEMCACHE_SNAPSHOT_KEY)
+    return stored[0] if stored else None
+
+
+def _load():
+    """Return the snapshot stored in memcache, or None."""
+    stored = memcache.get(MEMCACHE_SNAPSHOT_KEY)
+    if not stored:
+        return None
+    sequence, count = stored
+    keys = [MEMCACHE_SNAPSHOT_CHUNK_KEY % (sequence, i) for i in range(count)]
+    chunks = memcache.get_multi(keys)
+    if len(chunks) < count:
+        return None
+    snapshot = Snapshot(sequence)
+    for row in json.loads(zlib.decompress(''.join(chunks[key] for key in keys))):
+        snapshot.upsert(row)
+    return snapshot
+
+
+def _rebuild(sequence):
+    """Build a snapshot from the datastore."""
+    start = time.time()
+    snapshot = Snapshot(sequence)
+    for conf in Conference.query().iter(batch_size=REBUILD_BATCH_SIZE):
+        snapshot.upsert(_row(conf))
+    # the scan may miss writes it raced with; replaying the recent changes
+    # is harmless, since upserts are idempotent
+    first = max(0, sequence - MAX_REPLAY)
+    keys = [MEMCACHE_CHANGE_KEY % s for s in range(first + 1, sequence + 1)]
+    changes = memcache.get_multi(keys)
+    for key in keys:
+        if key in changes:
+            change = json.loads(changes[key])
+            if not change.get('reset'):
+                _apply(snapshot, change)
+    logging.info('Rebuilt conference index: %d rows in %.2fs',
+                 len(snapshot.keys), time.time() - start)
+    _store(snapshot)
+    return snapshot
+
+
+def _sequence():
+    """Return the number of the latest change, starting a log if needed."""
+    sequence = memcache.get(MEMCACHE_SEQUENCE_KEY)
+    if sequence is None:
+        # start from the clock so a lost counter never reuses old numbers;
+        # snapshots from before are then too far behind to replay
+        sequence = int(time.time())
+        if not memcache.add(MEMCACHE_SEQUENCE_KEY, sequence):
+            sequence = memcache.get(MEMCACHE_SEQUENCE_KEY) or sequence
+    return sequence
+
+
+def _queueRebuild(sequence):
+    """Queue a rebuild task, once per instance and sequence."""
+    if _rebuildQueued[0] == sequence:
+        return
+    _rebuildQueued[0] = sequence
+    try:
+        taskqueue.add(url=REBUILD_URL, countdown=REBUILD_DELAY,
+                      name='confindex-rebuild-%d' % sequence)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _current(build=False):
+    """Return this instance's snapshot, brought as up to date as the change
+    log allows; hold _lock. Without a snapshot in memcache to start from,
+    one is built from the datastore only if `build` is set; otherwise a
+    rebuild task is queued and IndexUnavailableError raised.
+    """
+    global _snapshot
+    sequence = _sequence()
+    if _snapshot is None:
+        _snapshot = _load()
+    if _snapshot is None:
+        if not build:
+            _queueRebuild(sequence)
+            raise IndexUnavailableError('The conference index is being rebuilt.')
+        _snapshot = _rebuild(sequence)
+        return _snapshot
+    behind = sequence - _snapshot.sequence
+    if not behind:
+        return _snapshot
+    if _replay(_snapshot, sequence):
+        if sequence % STORE_EVERY < behind:
+            # share the replayed snapshot now and then, to keep replays short
+            _store(_snapshot)
+        return _snapshot
+    # a gap, or a restarted log: switch to a stored snapshot that fits the
+    # log better, if there is one, else serve this one until a task stores it
+    stored = _storedSequence()
+    if stored is not None and stored <= sequence and (
+            stored > _snapshot.sequence or _snapshot.sequence > sequence):
+        _snapshot = _load() or _snapshot
+        if _replay(_snapshot, sequence):
+            return _snapshot
+    _queueRebuild(sequence)
+    return _snapshot
+
+
+def prime():
+    """Load or build this instance's snapshot ahead of its first query;
+    warmup requests are the only callers allowed to scan the datastore.
+    """
+    with _lock:
+        _current(build=True)
+
+
+def rebuild():
+    """Store a snapshot that is current with the change log, scanning the
+    datastore only if the stored one cannot be brought up to date; run by
+    the rebuild task.
+    """
+    sequence = _sequence()
+    snapshot = _load()
+    if snapshot is None:
+        _rebuild(sequence)
+        return
+    stored = snapshot.sequence
+    if not _replay(snapshot, sequence):
+        _rebuild(sequence)
+    elif snapshot.sequence != stored:
+        _store(snapshot)
+
+
+def query(filters, pageSize, pageToken=None):
+    """Return (conference keys as websafe strings, nextPageToken) for one
+    page of conferences matching all filters (as made by
+    ConferenceApi._formatFilters), ordered by name then key.
+
+    Raises ValueError for a malformed pageToken, and IndexUnavailableError
+    while an instance without a snapshot waits for the rebuild task.
+    """
+    after = _decodeToken(pageToken) if pageToken else None
+    with _lock:
+        wsks, last = _current().query(filters, pageSize, after)
+    return wsks, (_encodeToken(last) if last else None)
+
+
+def _encodeToken(last):
+    return base64.urlsafe_b64encode(json.dumps(list(last)))
+
+
+def _decodeToken(token):
+    try:
+        name, wsk = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page token.')
+    return name, wsk
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""importer.py
+
+Bulk import of conference and session catalogs.
+
+Rows are streamed from CSV or JSON-lines input and handled BATCH_SIZE at a
+time: IDs come from one allocate_ids call per parent, entities are stored
+with put_multi, and the confirmation emails and featured-speaker checks
+are queued with batched Queue.add calls. The ImportJob is checkpointed
+after every batch, so running a job again with the same input resumes
+where it stopped instead of duplicating rows.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import csv
+import itertools
+import json
+import time
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ImportJob
+from models import Profile
+from models import Session
+import announcements
+import batching
+import cache
+import confindex
+import seats
+import speakers
+import textsearch
+
+BATCH_SIZE = 200
+# stop early enough to answer within the request deadline
+TIME_BUDGET = 45
+LIST_SEPARATOR = ';'
+
+DEFAULTS = {
+    "city": "Default City",
+    "maxAttendees": 0,
+    "topics": [ "Default", "Topic" ],
+}
+
+
+class CatalogImportError(Exception):
+    """Raised for input rows that cannot be imported."""
+    pass
+
+
+def createJob(kind, format, organizerUserId=None):
+    """Create and store a new ImportJob."""
+    if kind == 'conference' and not organizerUserId:
+        raise CatalogImportError("Conference imports need an organizer.")
+    # conferences are children of their organizer's profile
+    if kind == 'conference' and not ndb.Key(Profile, organizerUserId).get():
+        raise CatalogImportError(
+            "No profile found for organizer: %s" % organizerUserId)
+    job = ImportJob(kind=kind, format=format, organizerUserId=organizerUserId)
+    job.put()
+    return job
+
+
+def runImport(job, stream, time_budget=TIME_BUDGET):
+    """Import rows from `stream` into the job until the input or the time
+    budget runs out; returns the number of rows imported by this run.
+    """
+    start = time.time()
+    rows_at_start = job.rowsDone
+    # skip the rows earlier runs already stored
+    rows = itertools.islice(_readRows(stream, job.format), job.rowsDone, None)
+    try:
+        while time.time() - start < time_budget:
+            batch = list(itertools.islice(rows, BATCH_SIZE))
+            if not batch:
+                job.status = 'done'
+                break
+            if job.kind == 'conference':
+                _importConferences(job, batch)
+            else:
+                _importSessions(job, batch)
+        else:
+            job.status = 'running'
+    except Exception as e:
+        job.status = 'failed'
+        job.error = '%s at row %d' % (e, job.rowsDone + 1)
+        job.put()
+        raise
+    job.error = None
+    job.put()
+    return job.rowsDone - rows_at_start
+
+# - - - Reading rows - - - - - - - - - - - - - - - - - - - - - -
+
+def _readRows(stream, format):
+    """Yield one dict per CSV row or JSON line."""
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _list(value):
+    if isinstance(value, list):
+        return value
+    return [v.strip() for v in (value or '').split(LIST_SEPARATOR) if v.strip()]
+
+
+def _int(value):
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+def _date(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def _time(value):
+    if not value:
+        return None
+    return datetime.strptime(value[:5], "%H:%M").time()
+
+# - - - Batches - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _allocateIds(job, model, counts):
+    """Return {websafe parent key: first ID} for a block of IDs per parent.
+
+    The allocation is saved on the job before anything is written, so a
+    retried batch reuses the same IDs and overwrites its earlier entities.
+    """
+    if job.pendingIds:
+        return job.pendingIds
+    futures = dict((parent.urlsafe(), model.allocate_ids_async(size=n, parent=parent))
+                   for parent, n in counts.items())
+    job.pendingIds = dict((wsk, future.get_result()[0])
+                          for wsk, future in futures.items())
+    job.put()
+    return job.pendingIds
+
+
+def _checkpoint(job, rows):
+    job.rowsDone += rows
+    job.pendingIds = None
+    job.put()
+
+
+def _importConferences(job, batch):
+    p_key = ndb.Key(Profile, job.organizerUserId)
+    prof_future = p_key.get_async()
+    first_id = _allocateIds(job, Conference, {p_key: len(batch)})[p_key.urlsafe()]
+
+    confs = []
+    for i, row in enumerate(batch):
+        if not row.get('name'):
+            raise CatalogImportError("Conference 'name' field required")
+        startDate = _date(row.get('startDate'))
+        maxAttendees = _int(row.get('maxAttendees')) or DEFAULTS['maxAttendees']
+        confs.append(Conference(
+            key=ndb.Key(Conference, first_id + i, parent=p_key),
+            name=row['name'],
+            description=row.get('description'),
+            organizerUserId=job.organizerUserId,
+            topics=_list(row.get('topics')) or DEFAULTS['topics'],
+            city=row.get('city') or DEFAULTS['city'],
+            startDate=startDate,
+            month=startDate.month if startDate else 0,
+            endDate=_date(row.get('endDate')),
+            maxAttendees=maxAttendees,
+            seatsAvailable=maxAttendees,
+        ))
+
+    shards = [shard for conf in confs
+              for shard in seats.makeShards(conf.key, conf.seatsAvailable)]
+    ndb.put_multi(confs + shards)
+    prof = prof_future.get_result()
+    if prof and prof.mainEmail:
+        batching.enqueueEmails([(prof.mainEmail,
+            'You created a new Conference!',
+            'Hi, you have created a following conference:\r\n\r\n%s' % conf.summary)
+            for conf in confs])
+    cache.bumpConferenceGeneration()
+    confindex.addConferences(confs)
+    textsearch.index('conference', confs)
+    announcements.seatsChanged([(conf.key, conf.name, conf.seatsAvailable)
+                                for conf in confs])
+    _checkpoint(job, len(batch))
+
+
+def _importSessions(job, batch):
+    c_keys = []
+    for row in batch:
+        if not row.get('name') or not row.get('speaker'):
+            raise CatalogImportError("Session 'name' and 'speaker' fields required")
+        if not speakers.normalizeName(row['speaker']):
+            raise CatalogImportError("Session 'speaker' field required")
+        c_keys.append(ndb.Key(urlsafe=row['websafeConferenceKey']))
+
+    counts = {}
+    for c_key in c_keys:
+        counts[c_key] = counts.get(c_key, 0) + 1
+    confs = dict(zip(counts.keys(), ndb.get_multi(counts.keys())))
+    missing = [c_key.urlsafe() for c_key, conf in confs.items() if conf is None]
+    if missing:
+        raise CatalogImportError('No conference found with key: %s' % missing[0])
+
+    # copy, since job.pendingIds has to keep the allocated starts
+    next_ids = dict(_allocateIds(job, Session, counts))
+    found = speakers.resolveSpeakers(row['speaker'] for row in batch)
+    sessions = []
+    for c_key, row in zip(c_keys, batch):
+        wsck = c_key.urlsafe()
+        sessions.append(Session(
+            key=ndb.Key(Session, next_ids[wsck], parent=c_key),
+            name=row['name'],
+            highlights=row.get('highlights'),
+            speaker=row['speaker'],
+            duration=_int(row.get('duration')),
+            typeOfSession=_list(row.get('typeOfSession')),
+            date=_date(row.get('date')),
+            startTime=_time(row.get('startTime')),
+            websafeConferenceKey=wsck,
+            speakerKey=found[row['speaker']].key,
+        ))
+        next_ids[wsck] += 1
+    ndb.put_multi(sessions)
+
+    # one confirmation per conference and one check per speaker in the batch
+    conf_keys = list(counts)
+    organizers = ndb.get_multi([c_key.parent() for c_key in conf_keys])
+    emails = []
+    for c_key, prof in zip(conf_keys, organizers):
+        if not (prof and prof.mainEmail):
+            continue
+        names = [s.name for s in sessions if s.key.parent() == c_key]
+        emails.append((prof.mainEmail,
+            'You created %d new Sessions!' % len(names),
+            'Hi, you have created the following sessions in '
+            '%s:\r\n\r\n%s' % (confs[c_key].name, '\r\n'.join(names))))
+    batching.enqueueEmails(emails)
+    speakerSessions = {}
+    for s, row in zip(sessions, batch):
+        speaker = found[row['speaker']].name
+        speakerSessions.setdefault((s.websafeConferenceKey, speaker), []).append(s.key.id())
+    textsearch.index('session', sessions)
+    batching.enqueueSpeakerChecks([(wsck, speaker, session_ids)
+        for (wsck, speaker), session_ids in sorted(speakerSessions.items())])
+    _checkpoint(job, len(batch))
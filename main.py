@@ -1,18 +1,45 @@
 #!/usr/bin/env python
+import json
+import logging
+import time
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from conference import ConferenceApi
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+import apistats
+import batching
+import speakers
+import textsearch
+# handlers of rare admin, cron and migration requests import their
+# modules when called, so new instances start faster
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Load the Endpoints service and prime the caches of a new instance."""
+        # API calls are served by the same instances
+        import conference
+        import announcements
+        import confindex
+        confindex.prime()
+        announcements.getAnnouncement()
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
-        """Set Announcement in Memcache."""
+        """Reconcile the nearly sold out announcement with the seat counts."""
         # TODO 1
-        # use _cacheAnnouncement() to set announcement in Memcache
-        ConferenceApi._cacheAnnouncement()
+        # registrations keep the announcement current in Memcache
+        import announcements
+        announcements.reconcile()
+
+class SyncSeatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Copy the seat shard totals onto the conferences."""
+        import announcements
+        import seats
+        seats.syncConferenceSeats()
+        announcements.reconcile()
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
@@ -39,18 +66,174 @@ class SendConfirmationOfSessionEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+class SendEmailDigestHandler(webapp2.RequestHandler):
+    def post(self):
+        """Send the confirmations queued for one recipient as one email."""
+        batching.sendEmailDigest(self.request.get('tag'))
+
+class DrainSpeakerChecksHandler(webapp2.RequestHandler):
+    def post(self):
+        """Count the sessions queued for one conference in one pass."""
+        batching.drainSpeakerChecks(self.request.get('tag'))
+
 class CheckFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
+        """Count the sessions of a speaker; updates the featured speaker.
+        Kept for tasks queued before checks were batched.
+        """
+        from models import Session
         wsck = self.request.get('websafeConferenceKey')
         speaker = self.request.get('speaker')
+        c_key = ndb.Key(urlsafe=wsck)
+        if not c_key.get():
+            logging.warning('No conference found with key: %s', wsck)
+            return
+        # these tasks name no sessions, so the stored ones are counted
+        sessions = Session.query(ancestor=c_key)
+        sessions = sessions.filter(Session.speaker == speaker)
+        sessions = sessions.order(Session.date).order(Session.startTime)
+        session_ids = [s_key.id() for s_key in sessions.fetch(keys_only=True)]
+        if not session_ids:
+            return
+        # stats count sessions under the Speaker's name
+        s_key = speakers.findSpeakerKey(speaker)
+        found = s_key and s_key.get()
         # Set new featured speaker in memcache if necessary
-        sessions = ConferenceApi._cacheFeaturedSpeaker(wsck, speaker)
-        if sessions.count() >= 2:
-            memcache.set(key="featuredSpeaker_" + wsck, value=speaker)
+        speakers.addSessions(c_key, {found.name if found else speaker: session_ids})
+
+class DrainSearchUpdatesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply the search index updates queued for one kind."""
+        batching.drainSearchUpdates(self.request.get('tag'))
+
+class BackfillSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start indexing stored conferences and sessions for search."""
+        for kind in textsearch.KINDS:
+            taskqueue.add(url='/tasks/backfill_search', params={'kind': kind})
+
+    def post(self):
+        """Queue one batch of a kind for indexing, then the next batch."""
+        kind = self.request.get('kind')
+        cursor = self.request.get('cursor')
+        cursor = textsearch.backfill(kind, Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(url='/tasks/backfill_search',
+                          params={'kind': kind, 'cursor': cursor.urlsafe()})
+
+class RebuildConferenceIndexHandler(webapp2.RequestHandler):
+    def post(self):
+        """Bring the stored conference index up to date with its change log."""
+        import confindex
+        confindex.rebuild()
+
+class InvalidateAgendasHandler(webapp2.RequestHandler):
+    def post(self):
+        """Drop the agendas showing an organizer's old display name."""
+        import agenda
+        agenda.invalidateOrganizer(ndb.Key(urlsafe=self.request.get('organizer')))
+
+class MigrateProfileKeysHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving profiles to key lists."""
+        import migrations
+        taskqueue.add(url='/tasks/migrate_profile_keys',
+                      params={'phase': migrations.PROFILE_KEY_PHASES[0]})
+
+    def post(self):
+        """Migrate one batch of profiles, then queue the next batch."""
+        import migrations
+        cursor = self.request.get('cursor')
+        phase, cursor = migrations.migrateProfileKeys(
+            self.request.get('phase'), Cursor(urlsafe=cursor) if cursor else None)
+        if phase:
+            params = {'phase': phase}
+            if cursor:
+                params['cursor'] = cursor.urlsafe()
+            taskqueue.add(url='/tasks/migrate_profile_keys', params=params)
+
+class BackfillSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start linking stored sessions to Speaker entities."""
+        self.post()
+
+    def post(self):
+        """Link one batch of sessions, then queue the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = speakers.backfillSessions(Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(url='/tasks/backfill_speakers',
+                          params={'cursor': cursor.urlsafe()})
+
+class ClearDataHandler(webapp2.RequestHandler):
+    def post(self):
+        """Clear batches of a clearAllData job, then queue the next task."""
+        import cleardata
+        job = cleardata.getJob(int(self.request.get('job')))
+        if not job:
+            logging.warning('No clear job found with id: %s', self.request.get('job'))
+            return
+        cleardata.run(job)
+
+class ImportCatalogHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import conferences or sessions from the CSV/JSON-lines body.
+
+        Query parameters: kind (conference|session), format (csv|jsonl),
+        organizer (user id, conference imports only) and job, to resume
+        an earlier import by posting the same input again.
+        """
+        import importer
+        from models import ImportJob
+        self.response.headers['Content-Type'] = 'application/json'
+        job_id = self.request.get('job')
+        if job_id:
+            job = ndb.Key(ImportJob, int(job_id)).get()
+            if not job:
+                self.abort(404, 'No import job found with id: %s' % job_id)
+        else:
+            kind = self.request.get('kind', 'session')
+            fmt = self.request.get('format', 'csv')
+            if kind not in ('conference', 'session') or fmt not in ('csv', 'jsonl'):
+                self.abort(400, 'Invalid kind or format.')
+            try:
+                job = importer.createJob(kind, fmt, self.request.get('organizer'))
+            except importer.CatalogImportError as e:
+                self.abort(400, str(e))
+
+        start = time.time()
+        rows = 0
+        try:
+            rows = importer.runImport(job, self.request.body_file)
+        except Exception:
+            logging.exception('Import job %d failed', job.key.id())
+            self.response.set_status(500)
+        elapsed = time.time() - start
+        self.response.write(json.dumps({
+            'job': job.key.id(),
+            'status': job.status,
+            'error': job.error,
+            'rowsDone': job.rowsDone,
+            'rowsThisRun': rows,
+            'seconds': round(elapsed, 3),
+            'rowsPerSecond': round(rows / elapsed, 1) if elapsed else None,
+        }))
 
-app = webapp2.WSGIApplication([
+app = apistats.middleware(webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/sync_seats', SyncSeatsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/send_confirmation_session_email', SendConfirmationOfSessionEmailHandler),
-    ('/tasks/check_featured_speaker', CheckFeaturedSpeakerHandler)
-], debug=True)
+    ('/tasks/check_featured_speaker', CheckFeaturedSpeakerHandler),
+    ('/tasks/send_email_digest', SendEmailDigestHandler),
+    ('/tasks/drain_speaker_checks', DrainSpeakerChecksHandler),
+    ('/tasks/backfill_speakers', BackfillSpeakersHandler),
+    ('/tasks/invalidate_agendas', InvalidateAgendasHandler),
+    ('/tasks/migrate_profile_keys', MigrateProfileKeysHandler),
+    ('/tasks/drain_search_updates', DrainSearchUpdatesHandler),
+    ('/tasks/backfill_search', BackfillSearchHandler),
+    ('/tasks/rebuild_conference_index', RebuildConferenceIndexHandler),
+    ('/tasks/clear_data', ClearDataHandler),
+    ('/admin/import', ImportCatalogHandler)
+], debug=True))
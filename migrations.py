@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Background rewrites of stored entities after schema changes, run as task
+chains: each task handles one batch and queues the next with a cursor.
+
+"""
+
+__author__ = 'Yu Lei'
+
+from google.appengine.ext import ndb
+
+from models import Profile
+
+BATCH_SIZE = 100
+
+# legacy properties to empty, in the order they are migrated
+PROFILE_KEY_PHASES = ['conferenceKeysToAttend', 'sessionKeysInWishlist']
+
+
+@ndb.transactional_tasklet()
+def _migrateProfile(p_key):
+    # the get hook already moved the strings into the key lists
+    profile = yield p_key.get_async()
+    if profile:
+        yield profile.put_async()
+
+
+def migrateProfileKeys(phase, cursor=None):
+    """Rewrite one batch of profiles still holding websafe-key strings in
+    the legacy property named by `phase`; returns (phase, cursor) to
+    continue with, or (None, None) once every profile is migrated.
+    """
+    legacy = getattr(Profile, phase)
+    # any non-empty string sorts after ''
+    query = Profile.query(legacy > '')
+    p_keys, next_cursor, more = query.fetch_page(
+        BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    # one small transaction per profile, so registrations are never lost
+    for future in [_migrateProfile(p_key) for p_key in p_keys]:
+        future.get_result()
+    if more:
+        return phase, next_cursor
+    following = PROFILE_KEY_PHASES.index(phase) + 1
+    if following < len(PROFILE_KEY_PHASES):
+        return PROFILE_KEY_PHASES[following], None
+    return None, None
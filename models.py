@@ -8,8 +8,7 @@ Udacity conference server-side Python App Engine data & ProtoRPC models
 
 __author__ = 'Yu Lei'
 
-import httplib
-import endpoints
+import json
 from protorpc import messages
 from google.appengine.ext import ndb
 
@@ -20,9 +19,83 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # indexed, so they double as the attendee indexes of conferences and
+    # sessions; change them through the methods below
+    conferencesToAttend = ndb.KeyProperty(kind='Conference', repeated=True)
+    sessionsInWishlist = ndb.KeyProperty(kind='Session', repeated=True)
+    # websafe-key strings of profiles stored before the key lists; moved
+    # over on get and emptied on the next put
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysInWishlist = ndb.StringProperty(repeated=True)
 
+    def upgradeKeys(self):
+        """Move websafe-key strings into the key lists; returns whether
+        there were any.
+        """
+        moved = False
+        for legacy, name in (('conferenceKeysToAttend', 'conferencesToAttend'),
+                             ('sessionKeysInWishlist', 'sessionsInWishlist')):
+            if getattr(self, legacy):
+                keys = getattr(self, name)
+                for key in (ndb.Key(urlsafe=wsk) for wsk in getattr(self, legacy)):
+                    if key not in keys:
+                        keys.append(key)
+                setattr(self, legacy, [])
+                moved = True
+        if moved:
+            self.__dict__.pop('_keySets', None)
+        return moved
+
+    def _pre_put_hook(self):
+        self.upgradeKeys()
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        profile = future.get_result()
+        if profile:
+            profile.upgradeKeys()
+
+    def _keySet(self, name):
+        """Set view of a key list, kept in step by the methods below."""
+        sets = self.__dict__.setdefault('_keySets', {})
+        if name not in sets:
+            sets[name] = set(getattr(self, name))
+        return sets[name]
+
+    def attends(self, c_key):
+        return c_key in self._keySet('conferencesToAttend')
+
+    def addConference(self, c_key):
+        if not self.attends(c_key):
+            self.conferencesToAttend.append(c_key)
+            self._keySet('conferencesToAttend').add(c_key)
+
+    def removeConference(self, c_key):
+        if self.attends(c_key):
+            self.conferencesToAttend.remove(c_key)
+            self._keySet('conferencesToAttend').discard(c_key)
+
+    def wishes(self, s_key):
+        return s_key in self._keySet('sessionsInWishlist')
+
+    def addSession(self, s_key):
+        if not self.wishes(s_key):
+            self.sessionsInWishlist.append(s_key)
+            self._keySet('sessionsInWishlist').add(s_key)
+
+    @classmethod
+    def attendersOf(cls, c_key):
+        """Query for the profiles attending a conference."""
+        # profiles not yet migrated only have the websafe string
+        return cls.query(ndb.OR(cls.conferencesToAttend == c_key,
+                                cls.conferenceKeysToAttend == c_key.urlsafe()))
+
+    @classmethod
+    def wishersOf(cls, s_key):
+        """Query for the profiles with a session in their wishlist."""
+        return cls.query(ndb.OR(cls.sessionsInWishlist == s_key,
+                                cls.sessionKeysInWishlist == s_key.urlsafe()))
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -40,6 +113,7 @@ class ProfileForm(messages.Message):
 class ProfileForms(messages.Message):
     """ProfileForms -- multiple Profile outbound form message"""
     items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 #-------------------------------Conference---------------------------
 class Conference(ndb.Model):
@@ -54,6 +128,24 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # ConferenceForm fields as JSON, precomputed on every put for listings
+    summary         = ndb.TextProperty()
+
+    def _pre_put_hook(self):
+        """Refresh the listing summary from the fields being stored."""
+        summary = {}
+        for field in ('name', 'description', 'organizerUserId', 'topics',
+                      'city', 'month', 'maxAttendees', 'seatsAvailable'):
+            value = getattr(self, field)
+            if value not in (None, []):
+                summary[field] = value
+        for field in ('startDate', 'endDate'):
+            value = getattr(self, field)
+            if value:
+                summary[field] = str(value)
+        if self.key:
+            summary['websafeKey'] = self.key.urlsafe()
+        self.summary = json.dumps(summary, separators=(',', ':'))
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -73,6 +165,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
@@ -83,19 +176,71 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+
+class WebsafeKeysForm(messages.Message):
+    """WebsafeKeysForm -- multiple websafe keys inbound form message"""
+    websafeKeys = messages.StringField(1, repeated=True)
+
+class BatchErrorForm(messages.Message):
+    """BatchErrorForm -- why one key of a batch request was not returned"""
+    websafeKey = messages.StringField(1)
+    error = messages.StringField(2)
+
+class ConferenceBatchForms(messages.Message):
+    """ConferenceBatchForms -- Conferences found plus per-key errors"""
+    items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    errors = messages.MessageField(BatchErrorForm, 2, repeated=True)
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
-class ConflictException(endpoints.ServiceException):
-    """ConflictException -- exception mapped to HTTP 409 response"""
-    http_status = httplib.CONFLICT
-
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
 
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm -- hit/miss counts of one response cache"""
+    name = messages.StringField(1)
+    hits = messages.IntegerField(2)
+    misses = messages.IntegerField(3)
+
+class CacheStatsForms(messages.Message):
+    """CacheStatsForms -- multiple CacheStatsForm outbound form message"""
+    items = messages.MessageField(CacheStatsForm, 1, repeated=True)
+
+class RpcCountForm(messages.Message):
+    """RpcCountForm -- RPCs of one type made by an API call"""
+    type = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+class LatencyBucketForm(messages.Message):
+    """LatencyBucketForm -- calls taking at most upperMs (no bound if unset)"""
+    upperMs = messages.IntegerField(1)
+    calls = messages.IntegerField(2)
+
+class ApiStatsForm(messages.Message):
+    """ApiStatsForm -- calls to one endpoint or task handler; p50Ms and
+    p99Ms are histogram bucket bounds, unset past the last bound"""
+    name = messages.StringField(1)
+    calls = messages.IntegerField(2)
+    errors = messages.IntegerField(3)
+    meanMs = messages.FloatField(4)
+    p50Ms = messages.IntegerField(5)
+    p99Ms = messages.IntegerField(6)
+    rpcs = messages.MessageField(RpcCountForm, 7, repeated=True)
+    entitiesPerCall = messages.FloatField(8)
+    memcacheHits = messages.IntegerField(9)
+    memcacheMisses = messages.IntegerField(10)
+    bytesPerCall = messages.FloatField(11)
+    histogram = messages.MessageField(LatencyBucketForm, 12, repeated=True)
+
+class ApiStatsForms(messages.Message):
+    """ApiStatsForms -- multiple ApiStatsForm outbound form message"""
+    items = messages.MessageField(ApiStatsForm, 1, repeated=True)
+
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
     NOT_SPECIFIED = 1
@@ -126,6 +271,8 @@ class Session(ndb.Model):
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty() 
     websafeConferenceKey =  ndb.StringProperty()
+    # the Speaker giving the session; indexed for getSessionsBySpeaker
+    speakerKey = ndb.KeyProperty(kind='Speaker')
 
 
 class SessionForm(messages.Message):
@@ -143,4 +290,122 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+class ScheduleConflictForm(messages.Message):
+    """ScheduleConflictForm -- two overlapping sessions, earlier first"""
+    first = messages.MessageField(SessionForm, 1)
+    second = messages.MessageField(SessionForm, 2)
+
+class ScheduleConflictForms(messages.Message):
+    """ScheduleConflictForms -- multiple ScheduleConflictForm outbound form message"""
+    items = messages.MessageField(ScheduleConflictForm, 1, repeated=True)
+
+class AgendaForm(messages.Message):
+    """AgendaForm -- wishlisted sessions in time order, plus their overlaps"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    conflicts = messages.MessageField(ScheduleConflictForm, 2, repeated=True)
+
+class ConferenceStats(ndb.Model):
+    """ConferenceStats -- per-conference aggregates kept up to date as
+    sessions are added; child of its Conference"""
+    # speaker name -> ids of that speaker's sessions in the conference
+    speakerSessions = ndb.JsonProperty()
+    featuredSpeaker = ndb.StringProperty(indexed=False)
+    topSpeakers = ndb.StringProperty(repeated=True, indexed=False)
+
+class Speaker(ndb.Model):
+    """Speaker -- Speaker object; the key id is the normalized name"""
+    name = ndb.StringProperty(indexed=False)
+    # other normalized names the speaker is known by
+    aliases = ndb.StringProperty(repeated=True)
+
+class SpeakerForm(messages.Message):
+    """SpeakerForm -- a speaker and their number of sessions"""
+    speaker = messages.StringField(1)
+    sessions = messages.IntegerField(2)
+    aliases = messages.StringField(3, repeated=True)
+
+class SpeakerForms(messages.Message):
+    """SpeakerForms -- multiple SpeakerForm outbound form message"""
+    items = messages.MessageField(SpeakerForm, 1, repeated=True)
+
+class SessionBatchForms(messages.Message):
+    """SessionBatchForms -- Sessions found plus per-key errors"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+    errors = messages.MessageField(BatchErrorForm, 2, repeated=True)
+
+
+#--------------------------------Seats---------------------------------
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of the seats still available for a conference"""
+    conference = ndb.KeyProperty(kind=Conference, indexed=False)
+    seats = ndb.IntegerProperty(default=0, indexed=False)
+
+#-----------------------------Announcement-----------------------------
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- the conferences with few seats left and the
+    announcement naming them; a single entity"""
+    # websafe conference key -> conference name
+    conferences = ndb.JsonProperty()
+    announcement = ndb.TextProperty()
+
+#--------------------------------Import--------------------------------
+
+class ImportJob(ndb.Model):
+    """ImportJob -- progress of one bulk conference/session import"""
+    kind = ndb.StringProperty(choices=['conference', 'session'])
+    format = ndb.StringProperty(choices=['csv', 'jsonl'])
+    organizerUserId = ndb.StringProperty(indexed=False)
+    rowsDone = ndb.IntegerProperty(default=0, indexed=False)
+    # IDs allocated for the batch in flight, by websafe parent key
+    pendingIds = ndb.JsonProperty()
+    status = ndb.StringProperty(default='running')
+    error = ndb.TextProperty()
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class ClearJob(ndb.Model):
+    """ClearJob -- progress of one clearAllData run"""
+    # kind being deleted, "Profile" while lists are reset, None when done
+    phase = ndb.StringProperty(indexed=False)
+    # websafe query cursor of the Profile phase
+    cursor = ndb.StringProperty(indexed=False)
+    # entities deleted (or profiles reset) so far, by kind
+    counts = ndb.JsonProperty()
+    # tasks run so far, used to name the next one
+    runs = ndb.IntegerProperty(default=0, indexed=False)
+    status = ndb.StringProperty(default='running')
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class ClearJobForm(messages.Message):
+    """ClearJobForm -- outbound progress of a clearAllData run"""
+    jobId = messages.IntegerField(1)
+    status = messages.StringField(2)
+    phase = messages.StringField(3)
+    deleted = messages.IntegerField(4)
+    profilesReset = messages.IntegerField(5)
+
+#--------------------------------Search--------------------------------
+
+class SearchTerm(ndb.Model):
+    """SearchTerm -- posting list of one token; id is "<kind>:<token>" """
+    # websafe key of each document holding the token -> its weight there
+    postings = ndb.JsonProperty(compressed=True)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- tokens last indexed for a document, so a new
+    version can be diffed against them; id is "<kind>:<websafe key>" """
+    terms = ndb.JsonProperty(compressed=True)
+
+#--------------------------------Agenda--------------------------------
 
+class Agenda(ndb.Model):
+    """Agenda -- display copies of the conferences a user attends and the
+    sessions in their wishlist; child of the Profile, id 'agenda'"""
+    # websafe key -> protojson ConferenceForm / SessionForm
+    conferences = ndb.JsonProperty(compressed=True)
+    sessions = ndb.JsonProperty(compressed=True)
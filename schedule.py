@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""schedule.py
+
+Overlap detection for session schedules.
+
+A session occupies [start, start + duration) with start taken from its date
+and startTime. findConflicts sorts the sessions by start and sweeps them
+once with a heap of the sessions still running, so a wishlist of n
+sessions with k overlapping pairs costs O(n log n + k) rather than
+comparing every pair.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import heapq
+from datetime import datetime
+from datetime import timedelta
+
+# minutes assumed for sessions stored without a duration
+DEFAULT_DURATION = 60
+
+
+def interval(session):
+    """Return (start, end) datetimes of a session, or None if it has no
+    date or start time and so cannot conflict with anything.
+    """
+    if session.date is None or session.startTime is None:
+        return None
+    start = datetime.combine(session.date, session.startTime)
+    duration = session.duration if session.duration is not None else DEFAULT_DURATION
+    return start, start + timedelta(minutes=max(duration, 0))
+
+
+def sortByStart(sessions):
+    """Return the scheduled sessions in start order, as (start, end, session)."""
+    timed = []
+    for i, session in enumerate(sessions):
+        span = interval(session)
+        if span:
+            # i breaks ties, so sessions themselves are never compared
+            timed.append((span[0], span[1], i, session))
+    timed.sort()
+    return [(start, end, session) for start, end, i, session in timed]
+
+
+def findConflicts(sessions):
+    """Return [(earlier, later)] for every pair of overlapping sessions,
+    grouped by the later session in start order.
+    """
+    conflicts = []
+    # (end, order, session) of sessions started but not yet over
+    running = []
+    for order, (start, end, session) in enumerate(sortByStart(sessions)):
+        while running and running[0][0] <= start:
+            heapq.heappop(running)
+        for _, _, other in running:
+            conflicts.append((other, session))
+        heapq.heappush(running, (end, order, session))
+    return conflicts
+
+
+def conflictsWith(session, sessions):
+    """Return the sessions overlapping `session`, in start order."""
+    span = interval(session)
+    if not span:
+        return []
+    start, end = span
+    return [other for other_start, other_end, other in sortByStart(sessions)
+            if other_start < end and start < other_end and other.key != session.key]
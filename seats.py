@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded counter of the seats available for each conference.
+
+A conference's seats are spread over NUM_SHARDS root SeatShard entities so
+that concurrent registrations write to different entity groups instead of
+all contending on the Conference entity. A registration reads the shards
+outside its transaction, then takes its seat from a single shard it
+re-checks inside, so the transaction spans one shard group whatever
+NUM_SHARDS is. The summed count is cached in memcache and kept current
+with incr/decr once a registration commits.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import SeatShard
+import cache
+
+NUM_SHARDS = 20
+MEMCACHE_SEATS_KEY = "seats_%s"
+SEATS_CACHE_TIME = 60
+
+
+def _shardKeys(c_key):
+    """Return the keys of all seat shards of a conference."""
+    wsck = c_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i)) for i in range(NUM_SHARDS)]
+
+
+def cacheKey(c_key):
+    """Return the memcache key holding the conference's summed seat count."""
+    return MEMCACHE_SEATS_KEY % c_key.urlsafe()
+
+
+def makeShards(c_key, seats):
+    """Return new shards splitting `seats` evenly over the conference."""
+    per_shard, extra = divmod(seats, NUM_SHARDS)
+    return [SeatShard(key=s_key, conference=c_key,
+                      seats=per_shard + (1 if i < extra else 0))
+            for i, s_key in enumerate(_shardKeys(c_key))]
+
+
+@ndb.transactional(xg=True)
+def _initLegacyShards(c_key):
+    """Create the shards of a conference stored before seats were sharded."""
+    if _shardKeys(c_key)[0].get():
+        return
+    conf = c_key.get()
+    ndb.put_multi(makeShards(c_key, conf.seatsAvailable or 0))
+
+
+def ensureShards(conf):
+    """Make sure the conference has seat shards; call outside a transaction."""
+    if memcache.get(cacheKey(conf.key)) is not None:
+        return
+    if not _shardKeys(conf.key)[0].get():
+        _initLegacyShards(conf.key)
+
+
+def getSeatsAvailable(confs, exact=True):
+    """Return {conference key: seats available} for the given conferences.
+
+    Counts come from memcache where possible; the rest are summed from one
+    batched get of their shards. Conferences without shards yet report the
+    seatsAvailable stored on the entity. With exact=False the shards are
+    not read at all and memcache misses report the stored count, which the
+    sync cron keeps current; listings use this so a page of conferences
+    costs one entity read per row rather than NUM_SHARDS.
+    """
+    return getSeatsAvailableByKeys(
+        [(conf.key, conf.seatsAvailable) for conf in confs], exact)
+
+
+def getSeatsAvailableByKey(c_key, default):
+    """Return the seats available for one conference, or `default` if it
+    has no shards yet.
+    """
+    return getSeatsAvailableByKeys([(c_key, default)])[c_key]
+
+
+def getSeatsAvailableByKeys(pairs, exact=True):
+    """Return {conference key: seats available} for (conference key,
+    fallback count) pairs; the fallback is used when there are no shards,
+    or on a memcache miss when `exact` is False.
+    """
+    fallbacks = dict(pairs)
+    cache_keys = dict((cacheKey(c_key), c_key) for c_key in fallbacks)
+    cached = memcache.get_multi(cache_keys.keys())
+    seats = dict((cache_keys[k], v) for k, v in cached.items())
+
+    missing = [c_key for c_key in fallbacks if c_key not in seats]
+    if not exact:
+        for c_key in missing:
+            seats[c_key] = fallbacks[c_key]
+    elif missing:
+        shard_keys = [_shardKeys(c_key) for c_key in missing]
+        shards = ndb.get_multi([k for keys in shard_keys for k in keys])
+        to_cache = {}
+        for i, c_key in enumerate(missing):
+            conf_shards = shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS]
+            if conf_shards[0] is None:
+                seats[c_key] = fallbacks[c_key]
+                continue
+            seats[c_key] = sum(s.seats for s in conf_shards if s)
+            to_cache[cacheKey(c_key)] = seats[c_key]
+        memcache.set_multi(to_cache, time=SEATS_CACHE_TIME)
+    return seats
+
+
+def shardsWithSeats(c_key):
+    """Return the keys of the conference's shards with seats left, in
+    random order; empty when sold out. Call outside a transaction.
+    """
+    keys = [shard.key for shard in ndb.get_multi(_shardKeys(c_key))
+            if shard and shard.seats > 0]
+    random.shuffle(keys)
+    return keys
+
+
+def takeSeat(c_key, s_key):
+    """Take one seat from the shard s_key, picked by shardsWithSeats;
+    returns False if it has none left by now. Must be called inside a
+    cross-group transaction.
+    """
+    shard = s_key.get()
+    if not shard or shard.seats <= 0:
+        return False
+    shard.seats -= 1
+    shard.put()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.decr(cacheKey(c_key)))
+    return True
+
+
+def returnSeat(c_key):
+    """Give one seat back to a random shard. Must be called inside a
+    cross-group transaction.
+    """
+    s_key = random.choice(_shardKeys(c_key))
+    shard = s_key.get() or SeatShard(key=s_key, conference=c_key)
+    shard.seats += 1
+    shard.put()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.incr(cacheKey(c_key)))
+
+
+def syncConferenceSeats(batch_size=100):
+    """Copy the shard totals back onto Conference.seatsAvailable, which the
+    seat filters and the announcement reconciliation still read. Conferences stored
+    before listing summaries existed are rewritten too, to get one.
+    """
+    cursor = None
+    more = True
+    while more:
+        confs, cursor, more = Conference.query().fetch_page(
+            batch_size, start_cursor=cursor)
+        seats = getSeatsAvailable(confs)
+        futures = [_syncSeatsAsync(conf.key, seats[conf.key]) for conf in confs
+                   if conf.seatsAvailable != seats[conf.key] or not conf.summary]
+        if any([future.get_result() for future in futures]):
+            cache.bumpConferenceGeneration()
+
+
+@ndb.transactional_tasklet
+def _syncSeatsAsync(c_key, seats):
+    """Store `seats` on a conference re-read in the transaction, so edits
+    made since the batch was read are kept; returns whether it was written.
+    """
+    conf = yield c_key.get_async()
+    if not conf or (conf.seatsAvailable == seats and conf.summary):
+        raise ndb.Return(False)
+    conf.seatsAvailable = seats
+    yield conf.put_async()
+    raise ndb.Return(True)
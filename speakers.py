@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Per-conference speaker aggregates, maintained incrementally.
+
+Each conference has one ConferenceStats child mapping speaker names to the
+ids of their sessions. Adding sessions is a single transactional
+read-modify-write of that entity, and adding the same session twice has no
+effect, so a retried task cannot double count. The featured speaker and
+the top speakers are recomputed from the map on every change.
+
+Speakers themselves are Speaker entities keyed by their normalized name,
+so spelling variants in case, accents, punctuation or spacing resolve to
+one speaker with a keyed read; other names go in Speaker.aliases. Sessions
+point at their speaker with Session.speakerKey, which makes "all sessions
+of a speaker" an indexed equality query independent of the session count.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import re
+import unicodedata
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import ConferenceStats
+from models import Session
+from models import Speaker
+
+MEMCACHE_FEATURED_SPEAKER_KEY = "featuredSpeaker_%s"
+TOP_SPEAKERS = 5
+# a speaker needs this many sessions in a conference to be featured
+FEATURED_MIN_SESSIONS = 2
+BACKFILL_BATCH = 200
+
+
+def _statsKey(c_key):
+    return ndb.Key(ConferenceStats, 'stats', parent=c_key)
+
+
+def _countSessions(c_key):
+    """Build the speaker map of a conference stored before stats existed.
+    Sessions are counted under their Speaker's name, as the session checks
+    are; call outside a transaction.
+    """
+    sessions = Session.query(ancestor=c_key).fetch()
+    # sessions stored before Speaker entities have no speakerKey yet
+    lookups = dict((s.speaker, _findSpeakerKeyAsync(normalizeName(s.speaker or '')))
+                   for s in sessions if s.speakerKey is None)
+    s_keys = [s.speakerKey or lookups[s.speaker].get_result() for s in sessions]
+    unique = list(set(k for k in s_keys if k))
+    names = dict((speaker.key, speaker.name)
+                 for speaker in ndb.get_multi(unique) if speaker)
+    speakerSessions = {}
+    for s, s_key in zip(sessions, s_keys):
+        speaker = names.get(s_key, s.speaker)
+        speakerSessions.setdefault(speaker, []).append(s.key.id())
+    return speakerSessions
+
+
+def addSessions(c_key, newSessions):
+    """Record sessions of a conference; newSessions maps speaker names to
+    ids of sessions (children of c_key) they give.
+    """
+    seed = None
+    if _statsKey(c_key).get() is None:
+        # looking up speakers takes other entity groups, so the map is
+        # built before the transaction
+        seed = _countSessions(c_key)
+    return _addSessions(c_key, newSessions, seed)
+
+
+@ndb.transactional()
+def _addSessions(c_key, newSessions, seed):
+    stats = _statsKey(c_key).get()
+    seeded = stats is None
+    if seeded:
+        stats = ConferenceStats(key=_statsKey(c_key),
+                                speakerSessions=dict(seed or {}))
+    speakerSessions = stats.speakerSessions or {}
+    for speaker, session_ids in sorted(newSessions.items()):
+        ids = speakerSessions.setdefault(speaker, [])
+        new_ids = [s_id for s_id in session_ids if s_id not in ids]
+        ids.extend(new_ids)
+
+        # the latest speaker to reach the threshold is featured, as before
+        if (new_ids or seeded) and len(ids) >= FEATURED_MIN_SESSIONS:
+            stats.featuredSpeaker = speaker
+    stats.topSpeakers = sorted(speakerSessions,
+        key=lambda name: (-len(speakerSessions[name]), name))[:TOP_SPEAKERS]
+    stats.speakerSessions = speakerSessions
+    stats.put()
+
+    wsck = c_key.urlsafe()
+    featured = stats.featuredSpeaker
+    if featured:
+        ndb.get_context().call_on_commit(lambda: memcache.set(
+            MEMCACHE_FEATURED_SPEAKER_KEY % wsck, featured))
+    return stats
+
+
+def getFeaturedSpeaker(c_key):
+    """Return the featured speaker of a conference, or ""."""
+    wsck = c_key.urlsafe()
+    featured = memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY % wsck)
+    if featured is None:
+        stats = _statsKey(c_key).get()
+        featured = (stats and stats.featuredSpeaker) or ""
+        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY % wsck, featured)
+    return featured
+
+
+def getTopSpeakers(c_key):
+    """Return [(speaker, number of sessions)] for the top speakers."""
+    stats = _statsKey(c_key).get()
+    if not stats:
+        return []
+    return [(name, len(stats.speakerSessions[name])) for name in stats.topSpeakers]
+
+# - - - Speaker entities - - - - - - - - - - - - - - - - - - - -
+
+def normalizeName(name):
+    """Return the lookup form of a speaker name, ignoring case, accents,
+    punctuation and repeated whitespace; "" if nothing is left.
+    """
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    return u' '.join(re.findall(r'\w+', name.lower(), re.UNICODE))
+
+
+@ndb.tasklet
+def _findSpeakerKeyAsync(norm):
+    """Return the key of the speaker with this normalized name or alias."""
+    if not norm:
+        raise ndb.Return(None)
+    s_key = ndb.Key(Speaker, norm)
+    speaker = yield s_key.get_async()
+    if speaker is None:
+        s_key = yield Speaker.query(Speaker.aliases == norm).get_async(keys_only=True)
+    raise ndb.Return(s_key)
+
+
+def findSpeakerKey(name):
+    """Return the key of the Speaker known by `name`, or None."""
+    return _findSpeakerKeyAsync(normalizeName(name)).get_result()
+
+
+@ndb.tasklet
+def _resolveSpeakerAsync(name):
+    norm = normalizeName(name)
+    s_key = yield _findSpeakerKeyAsync(norm)
+    if s_key is None:
+        # get_or_insert, so two first sessions of a speaker make one entity
+        speaker = yield Speaker.get_or_insert_async(norm, name=name)
+    else:
+        speaker = yield s_key.get_async()
+    raise ndb.Return(speaker)
+
+
+def resolveSpeakers(names):
+    """Return {name: Speaker} for speaker names, creating a Speaker for
+    names not seen before. Every name must normalize to a non-empty string.
+    """
+    futures = dict((name, _resolveSpeakerAsync(name)) for name in set(names))
+    return dict((name, future.get_result()) for name, future in futures.items())
+
+
+def addAlias(name, alias):
+    """Make `alias` another name of the speaker known by `name`.
+
+    Returns the updated Speaker, or None if no speaker is known by `name`.
+    Raises ValueError if the alias already names a different speaker.
+    """
+    s_key = findSpeakerKey(name)
+    if s_key is None:
+        return None
+    other = findSpeakerKey(alias)
+    if other is not None and other != s_key:
+        raise ValueError('%s is already another speaker' % alias)
+    return _addAlias(s_key, normalizeName(alias))
+
+
+@ndb.transactional()
+def _addAlias(s_key, norm):
+    speaker = s_key.get()
+    if norm != s_key.id() and norm not in speaker.aliases:
+        speaker.aliases.append(norm)
+        speaker.put()
+    return speaker
+
+
+def backfillSessions(cursor=None):
+    """Link up to BACKFILL_BATCH sessions stored before Speaker entities
+    existed to their speaker; returns the cursor to continue from, or None
+    once every session has been visited.
+    """
+    sessions, next_cursor, more = Session.query().fetch_page(
+        BACKFILL_BATCH, start_cursor=cursor)
+    todo = [s for s in sessions
+            if s.speakerKey is None and normalizeName(s.speaker)]
+    found = resolveSpeakers(s.speaker for s in todo)
+    for s in todo:
+        s.speakerKey = found[s.speaker].key
+    ndb.put_multi(todo)
+    return next_cursor if more else None
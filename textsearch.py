@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""textsearch.py
+
+Full-text search over conference and session text.
+
+Text is tokenized (lower case, accents and punctuation dropped, stop words
+skipped), and each token of a document is weighted by the fields it
+appears in. The inverted index lives in the datastore: one SearchTerm per
+kind and token maps document keys to weights, and one SearchDocument per
+document remembers its tokens so a new version can be diffed against
+them. Updates go through batching, so a burst of new sessions rewrites
+each posting list once.
+
+A query matches documents holding every query token, exactly or as the
+start of a longer token. Documents are ranked by their weights, with
+prefix matches and common tokens counting less. A token keeps at most
+MAX_POSTINGS documents, the ones where it weighs most; trimming a list is
+logged. Ranked keys are cached in memcache per normalized query.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import logging
+import math
+import re
+import unicodedata
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import SearchDocument
+from models import SearchTerm
+from models import Session
+import batching
+import cache
+
+KINDS = {
+    'conference': Conference,
+    'session': Session,
+}
+FIELD_WEIGHTS = {
+    'conference': {'name': 3, 'topics': 2, 'city': 1, 'description': 1},
+    'session': {'name': 3, 'speaker': 2, 'typeOfSession': 1, 'highlights': 1},
+}
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with',
+])
+# a prefix match counts this much of an exact one
+PREFIX_DISCOUNT = 0.5
+# longer tokens considered for one prefix
+MAX_EXPANSIONS = 20
+# only the heaviest postings of very common tokens are kept, so such a
+# token stops matching the documents where it weighs least
+MAX_POSTINGS = 5000
+# posting lists updated concurrently by one drain
+TERM_BATCH = 50
+MAX_RESULTS = 200
+BACKFILL_BATCH = 200
+
+
+def tokenize(text):
+    """Return the searchable tokens of a text, in order."""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return [token for token in re.findall(r'\w+', text.lower(), re.UNICODE)
+            if token not in STOP_WORDS]
+
+
+def documentTerms(kind, entity):
+    """Return {token: weight} for a Conference or Session."""
+    terms = {}
+    for field, weight in FIELD_WEIGHTS[kind].items():
+        value = getattr(entity, field)
+        for text in (value if isinstance(value, list) else [value]):
+            for token in tokenize(text or ''):
+                terms[token] = terms.get(token, 0) + weight
+    return terms
+
+
+def _termKey(kind, token):
+    return ndb.Key(SearchTerm, u'%s:%s' % (kind, token))
+
+
+def _documentKey(kind, wsk):
+    return ndb.Key(SearchDocument, '%s:%s' % (kind, wsk))
+
+# - - - Indexing - - - - - - - - - - - - - - - - - - - - - - - -
+
+def index(kind, entities):
+    """Queue entities of a kind to be (re)indexed."""
+    batching.enqueueSearchUpdates(kind, [(entity.key.urlsafe(),
+        documentTerms(kind, entity)) for entity in entities])
+
+
+def applyUpdates(kind, updates):
+    """Apply [(websafe key, {token: weight})] to the index; a later update
+    of the same document replaces an earlier one, and empty terms remove
+    the document.
+    """
+    latest = dict(updates)
+    if not latest:
+        return
+    wsks = sorted(latest)
+    docs = ndb.get_multi([_documentKey(kind, wsk) for wsk in wsks])
+    tokens = set()
+    for wsk, doc in zip(wsks, docs):
+        tokens.update(doc.terms if doc else [])
+        tokens.update(latest[wsk])
+    tokens = sorted(tokens)
+
+    # drains of one kind can overlap, so each posting list is re-read and
+    # written in its own transaction
+    for i in range(0, len(tokens), TERM_BATCH):
+        futures = [_updateTermAsync(kind, token,
+                                    dict((wsk, latest[wsk].get(token)) for wsk in wsks))
+                   for token in tokens[i:i + TERM_BATCH]]
+        for future in futures:
+            future.get_result()
+
+    puts, deletes = [], []
+    for wsk in wsks:
+        if latest[wsk]:
+            puts.append(SearchDocument(key=_documentKey(kind, wsk), terms=latest[wsk]))
+        else:
+            deletes.append(_documentKey(kind, wsk))
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+    cache.bumpSearchGeneration(kind)
+
+
+@ndb.transactional_tasklet
+def _updateTermAsync(kind, token, weights):
+    """Set the postings of a token to `weights`, {websafe key: weight};
+    documents with no weight are removed.
+    """
+    key = _termKey(kind, token)
+    term = yield key.get_async()
+    postings = term.postings if term else {}
+    for wsk, weight in weights.items():
+        if weight:
+            postings[wsk] = weight
+        else:
+            postings.pop(wsk, None)
+    if len(postings) > MAX_POSTINGS:
+        logging.warning('search term %s:%s has %d postings; keeping the %d heaviest',
+                        kind, token, len(postings), MAX_POSTINGS)
+        postings = dict(sorted(postings.items(),
+            key=lambda posting: -posting[1])[:MAX_POSTINGS])
+    if postings:
+        yield SearchTerm(key=key, postings=postings).put_async()
+    elif term:
+        yield key.delete_async()
+
+
+def backfill(kind, cursor=None):
+    """Queue up to BACKFILL_BATCH stored entities of a kind for indexing;
+    returns the cursor to continue from, or None once all were visited.
+    """
+    entities, next_cursor, more = KINDS[kind].query().fetch_page(
+        BACKFILL_BATCH, start_cursor=cursor)
+    index(kind, entities)
+    return next_cursor if more else None
+
+# - - - Searching - - - - - - - - - - - - - - - - - - - - - - - -
+
+@ndb.tasklet
+def _expandAsync(kind, token):
+    """Return the SearchTerms of a token and of tokens starting with it."""
+    start = _termKey(kind, token)
+    end = _termKey(kind, token + u'\ufffd')
+    keys = yield SearchTerm.query(SearchTerm.key >= start, SearchTerm.key < end
+        ).fetch_async(MAX_EXPANSIONS, keys_only=True)
+    terms = yield ndb.get_multi_async(keys)
+    raise ndb.Return([term for term in terms if term])
+
+
+def _rank(kind, tokens):
+    """Return [[websafe key, score]] of documents matching every token,
+    best first.
+    """
+    prefix = len(kind) + 1
+    scores = None
+    expansions = [_expandAsync(kind, token) for token in tokens]
+    for token, future in zip(tokens, expansions):
+        matches = {}
+        for term in future.get_result():
+            exact = term.key.id()[prefix:] == token
+            # common tokens say less about a document
+            factor = (1.0 if exact else PREFIX_DISCOUNT) / (1 + math.log(len(term.postings)))
+            for wsk, weight in term.postings.items():
+                matches[wsk] = max(matches.get(wsk, 0), weight * factor)
+        if scores is None:
+            scores = matches
+        else:
+            scores = dict((wsk, score + matches[wsk])
+                          for wsk, score in scores.items() if wsk in matches)
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return [[wsk, round(score, 4)] for wsk, score in ranked[:MAX_RESULTS]]
+
+
+def search(kind, query, offset, pageSize):
+    """Return (websafe keys, more) for one page of the documents of a kind
+    matching `query`, best first.
+    """
+    tokens = []
+    for token in tokenize(query):
+        if token not in tokens:
+            tokens.append(token)
+    if not tokens:
+        return [], False
+    cache_key, ranked = cache.getSearchResults(kind, tokens)
+    if ranked is None:
+        ranked = _rank(kind, tokens)
+        cache.setSearchResults(cache_key, ranked)
+    page = ranked[offset:offset + pageSize]
+    return [wsk for wsk, score in page], offset + pageSize < len(ranked)
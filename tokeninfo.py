@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""tokeninfo.py
+
+User ids of OAuth tokens, as reported by Google's tokeninfo service, for
+the "oauth" id type of utils.getUserId.
+
+Ids are cached by a hash of the token until the token expires. The cache
+has two levels: a bounded LRU per instance, then memcache. Lookups are
+ndb tasklets, and the service is called with the context's asynchronous
+urlfetch, so other RPCs keep running while it answers.
+
+A failed attempt is retried at once, without sleeping. If the service
+still fails, the instance backs off exponentially. While it backs off,
+tokens that are not cached resolve to '' at once instead of tying up
+requests. TOKENINFO_URL can point at a local stand-in of the service,
+such as benchutil.fakeTokeninfo in the benchmarks.
+
+"""
+
+__author__ = 'Yu Lei'
+
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+import urllib
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+FETCH_DEADLINE = 5
+FETCH_ATTEMPTS = 3
+LOCAL_CACHE_SIZE = 1000
+MEMCACHE_USER_ID_KEY = "tokenUserId_%s"
+# ids of long-lived tokens are checked again after this long
+MAX_CACHE_TIME = 3600
+BACKOFF_START = 1
+BACKOFF_MAX = 60
+
+# token hash -> (user id, expiry time), least recently used first
+_cache = collections.OrderedDict()
+_backoff = {'seconds': 0, 'until': 0}
+_lock = threading.Lock()
+
+# - - - Cache - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _hash(token):
+    return hashlib.sha256(token).hexdigest()
+
+
+def _localGet(token_hash):
+    with _lock:
+        entry = _cache.pop(token_hash, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        _cache[token_hash] = entry
+        return entry[0]
+
+
+def _localSet(token_hash, user_id, expires):
+    with _lock:
+        _cache.pop(token_hash, None)
+        _cache[token_hash] = (user_id, expires)
+        while len(_cache) > LOCAL_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def clearCache():
+    """Forget this instance's cached ids and backoff."""
+    with _lock:
+        _cache.clear()
+        _backoff.update(seconds=0, until=0)
+
+# - - - Backoff - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _backingOff():
+    return time.time() < _backoff['until']
+
+
+def _failed():
+    with _lock:
+        seconds = min(BACKOFF_MAX, _backoff['seconds'] * 2 or BACKOFF_START)
+        _backoff.update(seconds=seconds, until=time.time() + seconds)
+    logging.warning('tokeninfo unavailable; backing off for %ds', seconds)
+
+
+def _recovered():
+    with _lock:
+        _backoff.update(seconds=0, until=0)
+
+# - - - Lookups - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@ndb.tasklet
+def _tokenInfoAsync(token, token_type):
+    """Return the tokeninfo of a token, {} if the token is invalid, or
+    None if the service could not answer.
+    """
+    for attempt in range(FETCH_ATTEMPTS):
+        url = '%s?%s=%s' % (TOKENINFO_URL, token_type, urllib.quote(token, safe=''))
+        try:
+            resp = yield ndb.get_context().urlfetch(url, deadline=FETCH_DEADLINE)
+        except urlfetch.Error:
+            continue
+        if resp.status_code == 200:
+            _recovered()
+            raise ndb.Return(json.loads(resp.content))
+        if resp.status_code == 400 and 'invalid_token' in resp.content:
+            _recovered()
+            if token_type != 'id_token':
+                raise ndb.Return({})
+            # may be an access token after all
+            token_type = 'access_token'
+    _failed()
+    raise ndb.Return(None)
+
+
+@ndb.tasklet
+def getUserIdAsync(token, token_type='id_token'):
+    """Return the user id of an OAuth token, or '' if the token is
+    invalid or the tokeninfo service cannot be reached.
+    """
+    token_hash = _hash(token)
+    user_id = _localGet(token_hash)
+    if user_id is not None:
+        raise ndb.Return(user_id)
+    ctx = ndb.get_context()
+    cached = yield ctx.memcache_get(MEMCACHE_USER_ID_KEY % token_hash)
+    if cached and cached[1] > time.time():
+        _localSet(token_hash, *cached)
+        raise ndb.Return(cached[0])
+    if _backingOff():
+        raise ndb.Return('')
+
+    info = yield _tokenInfoAsync(token, token_type)
+    user_id = (info or {}).get('user_id', '')
+    cache_time = min(int((info or {}).get('expires_in', 0)), MAX_CACHE_TIME)
+    if user_id and cache_time > 0:
+        expires = time.time() + cache_time
+        _localSet(token_hash, user_id, expires)
+        yield ctx.memcache_set(MEMCACHE_USER_ID_KEY % token_hash,
+                               (user_id, expires), time=cache_time)
+    raise ndb.Return(user_id)
@@ -1,45 +1,50 @@
-import json
 import os
-import time
-import uuid
 
-from google.appengine.api import urlfetch
-from models import Profile
+from google.appengine.ext import ndb
+
+# tokeninfo, uuid and models are imported by the id types needing them;
+# every Endpoints request calls getUserId with the default "email"
 
 def getUserId(user, id_type="email"):
+    return getUserIdAsync(user, id_type).get_result()
+
+
+def getUserIdAsync(user, id_type="email"):
+    """Future version of getUserId, so callers can start their own RPCs
+    while an OAuth token is looked up.
+    """
     if id_type == "email":
-        return user.email()
+        future = ndb.Future()
+        future.set_result(user.email())
+        return future
 
     if id_type == "oauth":
         """A workaround implementation for getting userid."""
+        import tokeninfo
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        # cached until the token expires; see tokeninfo.py
+        return tokeninfo.getUserIdAsync(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
         # this is just a sample that queries datastore for an existing profile
         # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
+        return _customUserIdAsync(user)
+
+
+def _customUserIdAsync(user):
+    import uuid
+    from models import Profile
+
+    @ndb.tasklet
+    def lookup():
+        profile = yield Profile.query(Profile.mainEmail == user.email()).get_async()
         if profile:
-            return profile.id()
+            raise ndb.Return(profile.key.id())
         else:
-            return str(uuid.uuid1().get_hex())
+            raise ndb.Return(str(uuid.uuid1().get_hex()))
+    return lookup()